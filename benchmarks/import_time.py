@@ -0,0 +1,42 @@
+# Measures how long it takes to import the logger in a fresh interpreter.
+#
+# Usage: python benchmarks/import_time.py [--runs N] [module ...]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(statement: str, runs: int) -> list:
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, PYTHONDONTWRITEBYTECODE='1')
+    # Import and context creation must not need RTBH_JOB_NAME/RTBH_BUILD_ID.
+    env.pop('RTBH_JOB_NAME', None)
+    env.pop('RTBH_BUILD_ID', None)
+
+    durations = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], env=env, check=True)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('modules', nargs='*', default=['logger', 'logger.rtbh_log_relay.main'])
+    args = parser.parse_args()
+
+    baseline = statistics.median(measure('pass', args.runs))
+    print("%-40s %8.1f ms" % ("<interpreter startup>", baseline * 1000))
+    for module in args.modules:
+        duration = statistics.median(measure('import %s' % module, args.runs))
+        print("%-40s %8.1f ms (+%.1f ms)" % (module, duration * 1000, (duration - baseline) * 1000))
+
+
+if __name__ == '__main__':
+    main()
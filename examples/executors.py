@@ -0,0 +1,30 @@
+import multiprocessing
+
+from logger import get_rtbh_logger
+from logger.executors import ScopedProcessPoolExecutor, ScopedThreadPoolExecutor, with_current_scope
+from logger.scope import new_scope
+
+my_logger = get_rtbh_logger(__name__)
+
+
+def process_item(item):
+    # Logged in the scope of `process_all_items`, although it runs in another thread or process.
+    my_logger.info("Processing item %s", item)
+    return item * 2
+
+
+@new_scope
+def process_all_items():
+    with ScopedThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(process_item, range(10)))
+
+    with ScopedProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(process_item, range(10)))
+
+    # multiprocessing.Pool (and other APIs that take a callable) can use `with_current_scope`.
+    with multiprocessing.Pool(4) as pool:
+        pool.map(with_current_scope(process_item), range(10))
+
+
+if __name__ == '__main__':
+    process_all_items()
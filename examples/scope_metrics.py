@@ -0,0 +1,15 @@
+from logger import get_rtbh_logger
+from logger.scope import current_scope_metrics, manual_scope
+
+my_logger = get_rtbh_logger(__name__)
+
+# Instead of logging a message per item, aggregate values in the current scope.
+# Aggregated metrics are sent once, together with the end of the scope.
+with manual_scope("processing items"):
+    metrics = current_scope_metrics()
+    for item in range(10000):
+        metrics.count("items_processed")
+        metrics.observe("item_size", item % 100)
+
+    metrics.gauge("items_left", 0)
+    my_logger.info("Done processing items")
@@ -2,10 +2,8 @@ import logging
 import os
 
 from logger.network import StructuredLogHandler
-from logger.scope import LoggerScopeDecorator, NamedScopeDecorator, ScopeWithValueDecorator
-from logger.sender import LocalLogSender
-
-LoggerScopeDecorator.log_sender = LocalLogSender()
+from logger.scope import LoggerScopeDecorator, NamedScopeDecorator, ScopeWithValueDecorator, get_log_sender  # noqa: F401
+from logger.self_stats import get_logger_stats  # noqa: F401
 
 named_scope = NamedScopeDecorator
 scope_with_value = ScopeWithValueDecorator
@@ -16,7 +14,7 @@ def add_default_handlers(logger):
         console_handler = logging.StreamHandler()
         logger.addHandler(console_handler)
 
-    structured_handler = StructuredLogHandler(LoggerScopeDecorator.log_sender)
+    structured_handler = StructuredLogHandler(get_log_sender())
     logger.addHandler(structured_handler)
 
 
@@ -0,0 +1,17 @@
+import os
+import sys
+
+
+def get_float_env(name: str, default: float) -> float:
+    """
+    Returns the value of a numeric env variable. Invalid values are reported to stderr and replaced by `default`,
+    a typo in logger configuration must not break the application.
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        sys.stderr.write("Invalid value of %s: %r, using %s\n" % (name, value, default))
+        return default
@@ -0,0 +1,45 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Optional, TypeVar
+
+from logger.scope import get_scope_chain, inherited_scopes
+from logger.structs import LogicalScope
+
+T = TypeVar("T")
+
+
+class ScopedCall:
+    """
+    Picklable callable that runs `fun` in the scopes that were current when it was created.
+    Works with threads and processes, e.g. `multiprocessing.Pool().map(ScopedCall(fun), items)`.
+    """
+
+    def __init__(self, fun: Callable[..., T], scope_chain: Optional[List[LogicalScope]] = None):
+        self.fun = fun
+        self.scope_chain = get_scope_chain() if scope_chain is None else scope_chain
+
+    def __call__(self, *args, **kwargs) -> T:
+        with inherited_scopes(self.scope_chain):
+            return self.fun(*args, **kwargs)
+
+
+def with_current_scope(fun: Callable[..., T]) -> Callable[..., T]:
+    return ScopedCall(fun)
+
+
+class ScopedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that runs tasks (including `map`) in the scopes of the thread that submitted them.
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:  # pylint: disable=arguments-differ
+        return super().submit(ScopedCall(fn), *args, **kwargs)
+
+
+class ScopedProcessPoolExecutor(ProcessPoolExecutor):
+    """
+    ProcessPoolExecutor that runs tasks (including `map`) in the scopes of the thread that submitted them.
+    Tasks must be picklable, as for ProcessPoolExecutor.
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:  # pylint: disable=arguments-differ
+        return super().submit(ScopedCall(fn), *args, **kwargs)
@@ -0,0 +1,4 @@
+from logger.rtbh_log_relay.query import main
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import logging
+import time
 
 from logger.scope import create_log_entry
+from logger.self_stats import logger_stats
 from logger.structs import LogSender
 
 
@@ -16,6 +18,18 @@ class StructuredLogHandler(logging.Handler):
         self.log_sender = log_sender
 
     def emit(self, record: logging.LogRecord):
+        start_time = time.perf_counter()
         log_entry = create_log_entry(file=record.filename, line=record.lineno, level=record.levelname,
                                      message=record.getMessage(), args=record.args, exc_info=record.exc_info)
+        logger_stats.observe('create_entry', time.perf_counter() - start_time)
         self.log_sender.send_entries(log_entry)
+        logger_stats.observe('emit', time.perf_counter() - start_time)
+
+        if logger_stats.report_due():
+            self.report_stats()
+
+    def report_stats(self):
+        """Sends overhead stats of the logger (see logger.self_stats.LoggerStats) as a log entry."""
+        stats_entry = create_log_entry(file=__file__, line=0, level='INFO', message="Logger stats",
+                                       args=logger_stats.snapshot(), exc_info=None)
+        self.log_sender.send_entries(stats_entry)
@@ -0,0 +1,44 @@
+class AdaptiveConcurrency:
+    """
+    AIMD (additive increase, multiplicative decrease) limit of send requests in flight.
+
+    The limit grows by one after every batch that was sent within `latency_target` seconds and is multiplied by
+    `decrease_factor` after a batch that failed or was too slow. Consecutive failures additionally produce
+    an exponentially growing backoff delay, so a struggling central database is not hammered by retries.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, latency_target: float = 2.0, decrease_factor: float = 0.5,
+                 min_backoff: float = 0.5, max_backoff: float = 60.0):
+        assert 1 <= min_limit <= max_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.current_limit: float = float(max_limit)
+        self.num_consecutive_failures = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self.current_limit)
+
+    def on_success(self, latency: float):
+        self.num_consecutive_failures = 0
+        if latency > self.latency_target:
+            self.decrease()
+        else:
+            self.current_limit = min(float(self.max_limit), self.current_limit + 1)
+
+    def on_failure(self):
+        self.num_consecutive_failures += 1
+        self.decrease()
+
+    def decrease(self):
+        self.current_limit = max(float(self.min_limit), self.current_limit * self.decrease_factor)
+
+    def backoff_delay(self) -> float:
+        if self.num_consecutive_failures == 0:
+            return 0.0
+        return min(self.max_backoff, self.min_backoff * 2 ** (self.num_consecutive_failures - 1))
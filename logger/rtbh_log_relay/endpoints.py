@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from typing import Callable, Generic, List, NamedTuple, Optional, Sequence, TypeVar
+
+from logger.rtbh_log_relay import local_logger
+
+C = TypeVar('C')
+
+
+class Endpoint(NamedTuple):
+    url: str
+    region: Optional[str] = None
+
+    @staticmethod
+    def parse(spec: str) -> 'Endpoint':
+        """Parses 'URL' or 'REGION=URL'."""
+        region, separator, url = spec.partition('=')
+        if not separator or '://' in region:
+            return Endpoint(spec)
+        return Endpoint(url, region)
+
+
+class EndpointState(Generic[C]):
+    """Client of a single endpoint and what is known about its health and latency."""
+
+    def __init__(self, endpoint: Endpoint, client: C):
+        self.endpoint = endpoint
+        self.client = client
+        self.healthy = True
+        self.latency: Optional[float] = None  # EWMA of request latency, None until the first request succeeds
+        self.num_failures = 0  # consecutive failures
+        self.retry_time = 0.0  # when an unhealthy endpoint is checked again (monotonic)
+
+    def __repr__(self):
+        return "EndpointState(%s, healthy=%s, latency=%s)" % (self.endpoint.url, self.healthy, self.latency)
+
+
+class EndpointRouter(Generic[C]):
+    """
+    Picks the central database endpoint (coordinator) for each request.
+
+    Healthy endpoints in `local_region` are preferred, other healthy endpoints are used only if there are none.
+    Among preferred endpoints, the one with lower latency (EWMA) of two picked at random is used, which spreads
+    load between endpoints while avoiding slow ones.
+
+    An endpoint that fails a request is unhealthy until `check_health` succeeds. Health checks are made by
+    `check_unhealthy_endpoints` (see `check_health_forever`), with exponential backoff between failed checks.
+    If all endpoints are unhealthy, requests go to the one that will be checked first.
+    """
+
+    def __init__(self, endpoints: Sequence[Endpoint], create_client: Callable[[Endpoint], C],
+                 check_health: Callable[[C], None], local_region: Optional[str] = None, latency_alpha: float = 0.2,
+                 min_backoff: float = 1.0, max_backoff: float = 60.0):
+        assert endpoints, "At least one endpoint is required"
+        self.states: List[EndpointState[C]] = [EndpointState(endpoint, create_client(endpoint))
+                                               for endpoint in endpoints]
+        self.check_health = check_health
+        self.local_region = local_region
+        self.latency_alpha = latency_alpha
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def pick(self, exclude: Sequence[EndpointState[C]] = ()) -> EndpointState[C]:
+        """
+        :param exclude: Endpoints already tried by the current request, used only if there are no other endpoints.
+        """
+        with self.lock:
+            candidates = [state for state in self.states if state not in exclude] or self.states
+            healthy = [state for state in candidates if state.healthy]
+            if not healthy:
+                return min(candidates, key=lambda state: state.retry_time)
+
+            local = [state for state in healthy if state.endpoint.region == self.local_region]
+            preferred = local or healthy
+            if len(preferred) == 1:
+                return preferred[0]
+            first, second = random.sample(preferred, 2)
+            # Endpoints without latency are tried first, so that their latency is learned.
+            return min(first, second, key=lambda state: state.latency or 0.0)
+
+    def on_success(self, state: EndpointState[C], latency: float):
+        with self.lock:
+            if not state.healthy:  # used because all endpoints were unhealthy
+                state.healthy = True
+                state.num_failures = 0
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += self.latency_alpha * (latency - state.latency)
+
+    def on_failure(self, state: EndpointState[C]):
+        with self.lock:
+            if state.healthy:
+                local_logger.warning("Central database endpoint %s is unhealthy", state.endpoint.url)
+            self.mark_unhealthy(state)
+
+    def mark_unhealthy(self, state: EndpointState[C]):
+        state.healthy = False
+        state.num_failures += 1
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** (state.num_failures - 1))
+        state.retry_time = time.monotonic() + backoff
+
+    def check_unhealthy_endpoints(self):
+        now = time.monotonic()
+        with self.lock:
+            due = [state for state in self.states if not state.healthy and state.retry_time <= now]
+
+        for state in due:
+            try:
+                self.check_health(state.client)
+            except Exception as ex:  # pylint: disable=broad-except
+                local_logger.info("Health check of %s failed: %s", state.endpoint.url, ex)
+                with self.lock:
+                    self.mark_unhealthy(state)
+                continue
+
+            local_logger.info("Central database endpoint %s is healthy again", state.endpoint.url)
+            with self.lock:
+                state.healthy = True
+                state.num_failures = 0
+                state.latency = None  # measured again
+
+    def check_health_forever(self, stop: threading.Event, interval: float = 1.0):
+        while not stop.wait(interval):
+            self.check_unhealthy_endpoints()
@@ -0,0 +1,52 @@
+"""
+Cheap inspection of serialized LogSystem messages without decoding the whole JSON document.
+
+Messages are produced by `json.dumps(message.to_dict())` (see logger.structs), so the order of top-level keys is
+known. Quotes inside JSON strings are always escaped, so a quoted key followed by a colon is never a part of a value.
+"""
+import enum
+import re
+from typing import NamedTuple, Optional
+
+_LEVEL_RE = re.compile(rb'"level": ?"([A-Z]+)"')
+_THREAD_ID_RE = re.compile(rb'^\{"thread_id": ?"([^"]*)"')
+_SCOPE_PREFIX = rb'^\{"job_name": ?"(?:[^"\\]|\\.)*", ?"build_id": ?"(?:[^"\\]|\\.)*", ?"uid": ?"([^"]*)"'
+_SCOPE_UID_RE = re.compile(_SCOPE_PREFIX)
+_END_TIME_RE = re.compile(_SCOPE_PREFIX + rb', ?"end_time":')
+
+
+class EntryKind(enum.Enum):
+    log_entry = 'log_entry'
+    scope_start = 'scope_start'
+    scope_end = 'scope_end'
+    thread = 'thread'
+    other = 'other'
+
+
+class EntryInfo(NamedTuple):
+    kind: EntryKind
+    level: Optional[str]  # only for log entries
+    thread_id: Optional[str]  # only for log entries
+
+
+def classify_entry(data: bytes) -> EntryInfo:
+    thread_id_match = _THREAD_ID_RE.match(data)
+    if thread_id_match is not None:
+        # `level` follows `thread_id`, `scope_id` and `timestamp`, so the first match is the top-level key.
+        level_match = _LEVEL_RE.search(data)
+        level = level_match.group(1).decode('ascii') if level_match else None
+        return EntryInfo(EntryKind.log_entry, level, thread_id_match.group(1).decode('ascii'))
+
+    if _END_TIME_RE.match(data):
+        return EntryInfo(EntryKind.scope_end, None, None)
+    if b'"scope_path":' in data:
+        return EntryInfo(EntryKind.scope_start, None, None)
+    if b'"hostname":' in data:
+        return EntryInfo(EntryKind.thread, None, None)
+    return EntryInfo(EntryKind.other, None, None)
+
+
+def scope_uid(data: bytes) -> Optional[str]:
+    """Returns uid of a scope start or scope end message."""
+    match = _SCOPE_UID_RE.match(data)
+    return match.group(1).decode('ascii') if match else None
@@ -1,29 +1,68 @@
+import bisect
+import enum
 import multiprocessing as mp
 import queue
 import threading
-from typing import List
-
-import rocksdb
+import time
+from typing import List, Optional, Sequence, Union
 
 from logger.rtbh_log_relay import local_logger
-from logger.rtbh_log_relay.parallel_sender import SendRequest, SendResult, arango_sender_thread
+from logger.rtbh_log_relay.concurrency import AdaptiveConcurrency
+from logger.rtbh_log_relay.entries import EntryKind, classify_entry
+from logger.rtbh_log_relay.endpoints import Endpoint
+from logger.rtbh_log_relay.parallel_sender import (
+    DEFAULT_ENDPOINTS,
+    SendRequest,
+    SendResult,
+    arango_sender_thread,
+    pooled_arango_sender_thread,
+)
+from logger.rtbh_log_relay.queue_quota import QueueQuota
+from logger.rtbh_log_relay.retention import RetentionStore
+from logger.rtbh_log_relay.scope_coalescer import ScopeCoalescer
 from logger.rtbh_log_relay.uid import Uid
 
+DEFAULT_DB_PATH = '/tmp/rtbh-log-relay.db'
+
+# Backpressure level reported to clients is the number of thresholds reached by quota usage (if the queue has a quota)
+# or by the number of queued entries (otherwise). See logger.sender.BACKPRESSURE_DROPPED_LEVELS.
+BACKPRESSURE_USAGE_THRESHOLDS = (0.5, 0.8)
+BACKPRESSURE_ENTRIES_THRESHOLDS = (100000, 1000000)
+
+
+class SenderEngine(enum.Enum):
+    # `num_send_workers` processes, each sending one blocking request at a time.
+    processes = 'processes'
+    # Single process keeping `max_in_flight` requests in flight over pooled keep-alive connections.
+    pooled = 'pooled'
+
 
 class ParallelLogForwarder:
     """
     Forwards LogSystem messages received on unix domain socket to central database (Arango DB).
 
     It writes messages to local RocksDB (that acts as a persistent queue) before forwarding a message.
-    This way, in case of network failures, Arango DB temporary problems, etc. unhandled exception is raised
-    and log relay exits. Systemd restarts it immediately and log forwarder sends queued messages.
+    In case of network failures, Arango DB temporary problems, etc. failed messages stay in the queue and
+    the number of requests in flight is reduced (see AdaptiveConcurrency). Only fatal errors (e.g. a dead send
+    worker) raise an unhandled exception, log relay exits, systemd restarts it and log forwarder sends queued messages.
 
     Forwarding is not perfect (yet) but it's quite reliable. In case of failure that occurs after receiving a message from
     LocalLogSender and writing message to persistent queue, message is lost. In very rare cases log messages can be duplicated.
     """
 
-    def __init__(self, num_send_workers: int = 8):
-        self.db = rocksdb.DB("/tmp/rtbh-log-relay.db", rocksdb.Options(create_if_missing=True))
+    def __init__(self, num_send_workers: int = 8, sender_engine: SenderEngine = SenderEngine.processes,
+                 max_in_flight: int = 64, latency_target: float = 2.0, quota: Optional[QueueQuota] = None,
+                 scope_coalescer: Optional[ScopeCoalescer] = None, retention: Optional[RetentionStore] = None,
+                 db_path: str = DEFAULT_DB_PATH, endpoints: Sequence[Endpoint] = DEFAULT_ENDPOINTS,
+                 local_region: Optional[str] = None):
+        import rocksdb  # pylint: disable=import-outside-toplevel
+
+        self.db = rocksdb.DB(db_path, rocksdb.Options(create_if_missing=True))
+        self.quota = quota or QueueQuota()
+        self.scope_coalescer = scope_coalescer
+        self.retention = retention
+        self.eviction_lock = threading.Lock()
+        self.last_quota_warning_time = 0.0
 
         self.id_prefix = Uid.generate_short_uid() + b'-'
         self.seq_no = 0
@@ -35,18 +74,39 @@ class ParallelLogForwarder:
         self.entries_send_results_queue: mp.Queue = mp.Queue()
         self.work_done: mp.Event = mp.Event()
 
-        self.num_send_workers: int = num_send_workers
-        self.send_workers = [
-            mp.Process(
-                target=arango_sender_thread,
-                name="log-relay-sender-%d" % idx,
-                args=(self.entries_send_queue, self.entries_send_results_queue, self.work_done)
-            )
-            for idx in range(num_send_workers)
-        ]
+        if sender_engine == SenderEngine.pooled:
+            # Number of requests submitted in a single batch, i.e. number of requests in flight.
+            self.num_send_workers: int = max_in_flight
+            self.send_workers = [
+                mp.Process(
+                    target=pooled_arango_sender_thread,
+                    name="log-relay-sender-pooled",
+                    args=(self.entries_send_queue, self.entries_send_results_queue, self.work_done, max_in_flight,
+                          endpoints, local_region)
+                )
+            ]
+        else:
+            self.num_send_workers: int = num_send_workers
+            self.send_workers = [
+                mp.Process(
+                    target=arango_sender_thread,
+                    name="log-relay-sender-%d" % idx,
+                    args=(self.entries_send_queue, self.entries_send_results_queue, self.work_done,
+                          endpoints, local_region)
+                )
+                for idx in range(num_send_workers)
+            ]
         for p in self.send_workers:
             p.start()
 
+        self.concurrency = AdaptiveConcurrency(max_limit=self.num_send_workers, latency_target=latency_target)
+
+    @staticmethod
+    def create_write_batch():
+        import rocksdb  # pylint: disable=import-outside-toplevel
+
+        return rocksdb.WriteBatch()
+
     def handle_worker_failures(self):
         failed_workers = []
         for worker in self.send_workers:
@@ -64,9 +124,42 @@ class ParallelLogForwarder:
         iterator = self.db.iteritems()
         iterator.seek_to_first()
 
-        for entry_id, _ in iterator:
+        for entry_id, data in iterator:
+            self.quota.add(entry_id, data)
             self.received_event_ids.put(entry_id)
 
+        if self.quota.over_quota():
+            self.evict_entries()
+
+    def merge_queue(self, db_path: str, batch_size: int = 10000) -> int:
+        """
+        Moves entries of another persistent queue (e.g. of a shard that no longer runs) to this queue and deletes it.
+        If the relay dies before the other queue is deleted, its entries are merged again and duplicated.
+        """
+        import shutil  # pylint: disable=import-outside-toplevel
+
+        import rocksdb  # pylint: disable=import-outside-toplevel
+
+        other_db = rocksdb.DB(db_path, rocksdb.Options(create_if_missing=False), read_only=True)
+        iterator = other_db.itervalues()
+        iterator.seek_to_first()
+
+        num_entries = 0
+        batch = []
+        for data in iterator:
+            batch.append(data)
+            if len(batch) >= batch_size:
+                self.entries_received(batch)
+                num_entries += len(batch)
+                batch = []
+        if batch:
+            self.entries_received(batch)
+            num_entries += len(batch)
+
+        del iterator, other_db
+        shutil.rmtree(db_path)
+        return num_entries
+
     def generate_id(self):
         with self.seq_lock:
             self.seq_no += 1
@@ -74,10 +167,123 @@ class ParallelLogForwarder:
 
         return self.id_prefix + Uid.int_base_62(seq_id, 11)
 
-    def entry_received(self, data: bytes):
+    def entry_received(self, data: Union[bytes, memoryview]):
+        """
+        :param data: Encoded entry. It is copied, so it may be a view of a buffer that is reused by the caller.
+        """
+        data = bytes(data)
+        self.retain_entries([data])
+        if self.scope_coalescer is not None:
+            self.coalesce_entry(data)
+        else:
+            self.enqueue_entry(data)
+
+        if self.quota.over_quota():
+            self.evict_entries()
+
+    def entries_received(self, entries: List[bytes]):
+        """
+        Bulk version of `entry_received`, writes all entries to the persistent queue in a single batch.
+        """
+        self.retain_entries(entries)
+        if self.scope_coalescer is not None:
+            for data in entries:
+                self.coalesce_entry(data)
+        else:
+            entry_ids = [self.generate_id() for _ in entries]
+            batch = self.create_write_batch()
+            for entry_id, data in zip(entry_ids, entries):
+                batch.put(entry_id, data)
+            self.db.write(batch)
+            for entry_id, data in zip(entry_ids, entries):
+                self.quota.add(entry_id, data)
+                self.received_event_ids.put(entry_id)
+
+        if self.quota.over_quota():
+            self.evict_entries()
+
+    def retain_entries(self, entries: List[bytes]):
+        """Indexes received entries in the retention store, if there is one."""
+        if self.retention is None:
+            return
+        # Retention ids are independent of queue ids, completed scopes (see ScopeCoalescer) get new queue ids.
+        self.retention.add_entries([(self.generate_id(), data) for data in entries])
+
+    def enqueue_entry(self, data: bytes):
+        entry_id = self.store_entry(data)
+        self.received_event_ids.put(entry_id)
+
+    def store_entry(self, data: bytes) -> bytes:
         entry_id = self.generate_id()
         self.db.put(entry_id, data)
-        self.received_event_ids.put(entry_id)
+        self.quota.add(entry_id, data)
+        return entry_id
+
+    def coalesce_entry(self, data: bytes):
+        kind = classify_entry(data).kind
+        if kind == EntryKind.scope_start:
+            entry_id = self.store_entry(data)
+            for released_id in self.scope_coalescer.hold_start(entry_id, data):
+                self.received_event_ids.put(released_id)
+            return
+
+        if kind == EntryKind.scope_end:
+            completed = self.scope_coalescer.complete(data)
+            if completed is not None:
+                start, completed_data = completed
+                # Replace held scope start with the completed scope.
+                completed_id = self.generate_id()
+                batch = self.create_write_batch()
+                batch.delete(start.entry_id)
+                batch.put(completed_id, completed_data)
+                self.db.write(batch)
+                self.quota.remove(start.entry_id, start.data)
+                self.quota.add(completed_id, completed_data)
+                self.received_event_ids.put(completed_id)
+                return
+
+        self.enqueue_entry(data)
+
+    def release_expired_scopes(self):
+        if self.scope_coalescer is not None:
+            for entry_id in self.scope_coalescer.release_expired():
+                self.received_event_ids.put(entry_id)
+
+    def evict_entries(self):
+        """
+        Deletes the least valuable entries from the queue until it fits in its quota and records how much was
+        evicted, see QueueQuota.take_eviction_summaries. Evicted entry ids stay in `received_event_ids` and are
+        skipped when sending.
+        """
+        if not self.eviction_lock.acquire(blocking=False):
+            return  # another thread is already evicting
+        try:
+            evicted = self.quota.pick_entries_to_evict()
+            if not evicted:
+                now = time.monotonic()
+                if now - self.last_quota_warning_time > 60:
+                    self.last_quota_warning_time = now
+                    local_logger.warning("Queue exceeds its quota, but there are no entries that can be evicted")
+                return
+
+            batch = self.create_write_batch()
+            for entry in evicted:
+                batch.delete(entry.entry_id)
+            self.db.write(batch)
+            local_logger.warning("Queue exceeded its quota, evicted %d entries", len(evicted))
+            self.quota.record_evictions(evicted)
+        finally:
+            self.eviction_lock.release()
+
+    def enqueue_eviction_summaries(self):
+        for data in self.quota.take_eviction_summaries():
+            self.enqueue_entry(data)
+
+    def backpressure_level(self) -> int:
+        """Returns 0 if the queue is healthy, higher values the more overloaded it is (up to 2)."""
+        if self.quota.limited:
+            return bisect.bisect_right(BACKPRESSURE_USAGE_THRESHOLDS, self.quota.usage())
+        return bisect.bisect_right(BACKPRESSURE_ENTRIES_THRESHOLDS, self.quota.num_entries)
 
     def get_n_entry_ids(self, n: int) -> List:
         result = []
@@ -108,24 +314,61 @@ class ParallelLogForwarder:
         return num_sent
 
     def send_queued_entries_batch(self):
-        entry_ids = self.get_n_entry_ids(self.num_send_workers)
+        """
+        Sends up to `concurrency.limit` entries concurrently. Returns the number of entries sent successfully.
+        """
+        self.release_expired_scopes()
+        self.enqueue_eviction_summaries()
+        entry_ids = self.get_n_entry_ids(self.concurrency.limit)
+        if not entry_ids:
+            return 0
 
         # Submit send requests
+        start_time = time.monotonic()
+        requests = {}
         for entry_id in entry_ids:
-            self.entries_send_queue.put(SendRequest(entry_id, self.db.get(entry_id)))
+            entry = self.db.get(entry_id)
+            if entry is None or not self.quota.claim(entry_id, entry):
+                continue  # evicted
+            requests[entry_id] = entry
+            self.entries_send_queue.put(SendRequest(entry_id, entry))
 
         # Await send results
         errors = []
-        for _ in range(len(entry_ids)):
+        num_dropped = 0
+        for _ in range(len(requests)):
             send_result = self.get_send_result()
-            if send_result.exception is not None:
+            if send_result.exception is not None and send_result.exception.permanent:
+                # Retrying would fail again, so the entry is dropped.
+                local_logger.error("Entry %s was rejected, dropping it: %s. Entry: %.1000r",
+                                   send_result.entry_id, send_result.exception, requests[send_result.entry_id])
+                self.db.delete(send_result.entry_id)
+                self.quota.remove(send_result.entry_id, requests[send_result.entry_id])
+                num_dropped += 1
+            elif send_result.exception is not None:
                 errors.append(send_result.exception)
+                self.quota.release(send_result.entry_id)
                 self.received_event_ids.put(send_result.entry_id)
             else:
                 self.db.delete(send_result.entry_id)
+                self.quota.remove(send_result.entry_id, requests[send_result.entry_id])
+        latency = time.monotonic() - start_time
+
+        if not requests:
+            return 0
+        if not errors:
+            self.concurrency.on_success(latency)
+            return len(requests) - num_dropped
 
-        if errors:
-            local_logger.error("Errors while sending: %s", errors)
-            raise errors[0]
+        fatal_errors = [e for e in errors if e.fatal]
+        if fatal_errors:
+            local_logger.error("Fatal errors while sending: %s", fatal_errors)
+            raise fatal_errors[0]
 
-        return len(entry_ids)
+        self.concurrency.on_failure()
+        delay = self.concurrency.backoff_delay()
+        local_logger.warning("Errors while sending (%d of %d failed): %s. "
+                             "Retrying in %.1f s with %d requests in flight",
+                             len(errors), len(requests), errors[0], delay, self.concurrency.limit)
+        time.sleep(delay)
+        return len(requests) - len(errors) - num_dropped
@@ -1,10 +1,22 @@
+import argparse
 import datetime
+import glob
+import multiprocessing as mp
 import os
 import threading
+import time
+from typing import List, Optional
 
 from logger.rtbh_log_relay import local_logger, setup_logger
-from logger.rtbh_log_relay.forwarder import ParallelLogForwarder
-from logger.rtbh_log_relay.server import LocalLogServer
+from logger.rtbh_log_relay.endpoints import Endpoint
+from logger.rtbh_log_relay.forwarder import DEFAULT_DB_PATH, ParallelLogForwarder, SenderEngine
+from logger.rtbh_log_relay.parallel_sender import DEFAULT_ENDPOINTS
+from logger.rtbh_log_relay.queue_quota import QueueQuota
+from logger.rtbh_log_relay.retention import DEFAULT_RETENTION_PATH, RetentionStore
+from logger.rtbh_log_relay.scope_coalescer import ScopeCoalescer
+from logger.rtbh_log_relay.segments import SegmentIngester
+from logger.rtbh_log_relay.server import DEFAULT_MAX_ENTRY_SIZE, LocalLogServer
+from logger.sender import DEFAULT_SERVER_ADDRESS, shard_address, shards_file_path
 
 
 class Sender:
@@ -29,28 +41,195 @@ class Sender:
                 raise Exception("Socket file is missing")
 
 
-def main():
-    setup_logger()
-
-    server_address = '/tmp/rtbh-log-relay.socket'
-
-    local_logger.info("Started parallel log forwarder (%s)", server_address)
-    forwarder = ParallelLogForwarder()
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Relays structured logs from local processes to the central database.")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Number of ingest processes. Each shard has its own socket, persistent queue and senders. "
+                             "Shard 0 uses the persistent queue of the non-sharded relay.")
+    parser.add_argument('--sender-engine', type=SenderEngine, default=SenderEngine.processes,
+                        metavar='{%s}' % ','.join(e.value for e in SenderEngine),
+                        help="'processes' runs --num-send-workers blocking sender processes, "
+                             "'pooled' runs a single process with --max-in-flight concurrent requests.")
+    parser.add_argument('--num-send-workers', type=int, default=8)
+    parser.add_argument('--max-in-flight', type=int, default=64)
+    parser.add_argument('--latency-target', type=float, default=2.0,
+                        help="Batches slower than this (seconds) reduce the number of requests in flight.")
+    parser.add_argument('--max-queue-bytes', type=int, default=0,
+                        help="Quota for the persistent queue. When exceeded, DEBUG and then INFO entries are evicted "
+                             "(oldest first). 0 means no limit.")
+    parser.add_argument('--max-queue-entries', type=int, default=0,
+                        help="Maximum number of entries in the persistent queue, 0 means no limit.")
+    parser.add_argument('--coalesce-scopes-window', type=float, default=0.0,
+                        help="Scopes that end within this many seconds are sent as a single completed scope document. "
+                             "0 disables coalescing.")
+    parser.add_argument('--max-pending-scopes', type=int, default=10000,
+                        help="Maximum number of scope starts held while waiting for their ends.")
+    parser.add_argument('--retention-seconds', type=float, default=0.0,
+                        help="Keep received entries in a local store for this many seconds, "
+                             "so they can be queried with logger/log_relay_query.py. 0 disables the store.")
+    parser.add_argument('--retention-path', default=DEFAULT_RETENTION_PATH)
+    parser.add_argument('--max-entry-size', type=int, default=DEFAULT_MAX_ENTRY_SIZE,
+                        help="Larger entries are dropped and rejected.")
+    parser.add_argument('--segment-dir',
+                        help="Bulk-ingest segment files written by SegmentLogSender to this directory.")
+    parser.add_argument('--central-db', type=Endpoint.parse, action='append', dest='endpoints',
+                        metavar='[REGION=]URL',
+                        help="Central database endpoint (coordinator), may be repeated. Entries are sent to healthy "
+                             "endpoints in --region first, choosing faster ones, and fail over to other endpoints. "
+                             "Default: %s." % DEFAULT_ENDPOINTS[0].url)
+    parser.add_argument('--region', help="Region of this host, see --central-db.")
+    return parser.parse_args(argv)
+
+
+def create_scope_coalescer(args: argparse.Namespace) -> Optional[ScopeCoalescer]:
+    if args.coalesce_scopes_window <= 0:
+        return None
+    return ScopeCoalescer(window=args.coalesce_scopes_window, max_pending=args.max_pending_scopes)
+
+
+def create_retention_store(args: argparse.Namespace) -> Optional[RetentionStore]:
+    if args.retention_seconds <= 0:
+        return None
+    return RetentionStore(args.retention_path, max_age=args.retention_seconds)
+
+
+def create_forwarder(args: argparse.Namespace, db_path: str, num_shards: int) -> ParallelLogForwarder:
+    # Quota is split evenly between shards.
+    quota = QueueQuota(args.max_queue_bytes // num_shards, args.max_queue_entries // num_shards)
+    return ParallelLogForwarder(num_send_workers=args.num_send_workers, sender_engine=args.sender_engine,
+                                max_in_flight=args.max_in_flight, latency_target=args.latency_target,
+                                quota=quota,
+                                scope_coalescer=create_scope_coalescer(args),
+                                retention=create_retention_store(args),
+                                db_path=db_path,
+                                endpoints=args.endpoints or DEFAULT_ENDPOINTS,
+                                local_region=args.region)
+
+
+def shard_db_path(shard: int) -> str:
+    return DEFAULT_DB_PATH if shard == 0 else '%s.shard-%d' % (DEFAULT_DB_PATH, shard)
+
+
+def find_stale_shard_dbs(num_shards: int) -> List[str]:
+    """Returns persistent queues of shards that do not run with `num_shards` shards (left by a previous run)."""
+    prefix = DEFAULT_DB_PATH + '.shard-'
+    result = []
+    for path in glob.glob(glob.escape(prefix) + '*'):
+        shard = path[len(prefix):]
+        if shard.isdigit() and int(shard) >= num_shards:
+            result.append(path)
+    return sorted(result)
+
+
+def merge_stale_shard_dbs(forwarder: ParallelLogForwarder, num_shards: int):
+    for path in find_stale_shard_dbs(num_shards):
+        try:
+            num_entries = forwarder.merge_queue(path)
+        except Exception:  # pylint: disable=broad-except
+            local_logger.exception("Failed to merge queue of a stale shard (%s), its entries are not sent", path)
+            continue
+        local_logger.info("Merged %d queued entries of a stale shard (%s)", num_entries, path)
+
+
+def run_relay(args: argparse.Namespace, server_address: str, db_path: str, num_shards: int, primary: bool):
+    """
+    :param primary: True for the relay that is not sharded and for shard 0. The primary relay ingests segments and
+    takes over queues of shards that no longer run (e.g. after --shards was lowered).
+    """
+    local_logger.info("Started parallel log forwarder (%s, engine=%s)", server_address, args.sender_engine.value)
+    forwarder = create_forwarder(args, db_path, num_shards)
 
     try:
         forwarder.read_pending_events_from_db()
+        if primary:
+            merge_stale_shard_dbs(forwarder, num_shards)
 
-        server = LocalLogServer(server_address, forwarder)
+        server = LocalLogServer(server_address, forwarder, max_entry_size=args.max_entry_size)
 
         server_thread = threading.Thread(target=server.serve_forever)
         server_thread.daemon = True
         server_thread.start()
 
+        if primary and args.segment_dir:
+            ingester = SegmentIngester(args.segment_dir, forwarder)
+            ingester_thread = threading.Thread(target=ingester.ingest_forever)
+            ingester_thread.daemon = True
+            ingester_thread.start()
+
         Sender(server_address, forwarder, True).send_forever()
     except Exception:
         forwarder.work_done.set()
         raise
 
 
+def run_shard(args: argparse.Namespace, shard: int):
+    setup_logger()
+    run_relay(args, shard_address(DEFAULT_SERVER_ADDRESS, shard), shard_db_path(shard), args.shards,
+              primary=shard == 0)
+
+
+class ShardSupervisor:
+    """
+    Runs each shard of the relay in a separate process and restarts shards that exit.
+
+    Clients find the number of shards in the shards file and pick a shard by their pid (see LocalLogSender).
+    The default socket path is a link to the socket of shard 0, for clients that do not know about shards.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.shards: List[Optional[mp.Process]] = [None] * args.shards
+
+    def start_shard(self, shard: int):
+        process = mp.Process(target=run_shard, name="log-relay-shard-%d" % shard, args=(self.args, shard))
+        process.start()
+        self.shards[shard] = process
+
+    def publish_shards(self):
+        shards_file = shards_file_path(DEFAULT_SERVER_ADDRESS)
+        with open(shards_file + '.tmp', 'w') as f:
+            f.write(str(self.args.shards))
+        os.chmod(shards_file + '.tmp', 0o644)
+        os.replace(shards_file + '.tmp', shards_file)
+
+        link_tmp = DEFAULT_SERVER_ADDRESS + '.tmp'
+        if os.path.lexists(link_tmp):
+            os.unlink(link_tmp)
+        os.symlink(shard_address(DEFAULT_SERVER_ADDRESS, 0), link_tmp)
+        os.replace(link_tmp, DEFAULT_SERVER_ADDRESS)
+
+    def run_forever(self):
+        for shard in range(self.args.shards):
+            self.start_shard(shard)
+        self.publish_shards()
+        local_logger.info("Started %d relay shards", self.args.shards)
+
+        try:
+            while True:
+                time.sleep(1)
+                for shard, process in enumerate(self.shards):
+                    if not process.is_alive():
+                        local_logger.warning("Relay shard %d exited with code %s, restarting it", shard, process.exitcode)
+                        self.start_shard(shard)
+        finally:
+            for process in self.shards:
+                if process is not None and process.is_alive():
+                    process.terminate()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logger()
+
+    if args.shards > 1:
+        ShardSupervisor(args).run_forever()
+        return
+
+    # Not sharded anymore, clients must connect to the default socket.
+    if os.path.exists(shards_file_path(DEFAULT_SERVER_ADDRESS)):
+        os.unlink(shards_file_path(DEFAULT_SERVER_ADDRESS))
+    run_relay(args, DEFAULT_SERVER_ADDRESS, DEFAULT_DB_PATH, num_shards=1, primary=True)
+
+
 if __name__ == '__main__':
     main()
@@ -1,16 +1,36 @@
 # Used to send logs over network to the arango db.
 # Uses multiple processes for performance.
 # One process transfers ~40 entries/second.
+#
+# Alternatively, a single process can keep many requests in flight using a pool of threads
+# that share keep-alive HTTP connections (see PooledArangoLogSender).
+#
+# Each entry is sent to one of central database endpoints (coordinators), see EndpointRouter.
 import json
 import multiprocessing as mp
 import queue
-from typing import Dict, NamedTuple, Optional
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Sequence
 
-from arango import ArangoClient, DocumentInsertError
+# python-arango is imported only by send workers, it is slow to import.
+# pylint: disable=import-outside-toplevel
+if TYPE_CHECKING:
+    from arango import ArangoClient
+    from arango.database import StandardDatabase
 
-__all__ = ["arango_sender_thread", "SendRequest", "SendResult"]
+__all__ = ["arango_sender_thread", "pooled_arango_sender_thread", "SendError", "SendRequest", "SendResult"]
 
 from logger.rtbh_log_relay import local_logger
+from logger.rtbh_log_relay.endpoints import Endpoint, EndpointRouter, EndpointState
+
+CENTRAL_DB_HOSTS = 'http://arango-central-db.example:9966'
+DEFAULT_ENDPOINTS = (Endpoint(CENTRAL_DB_HOSTS), )
+
+# Client errors that are not caused by the entry: timeouts, rate limiting and errors that would fail every entry
+# (authentication, missing collection). Other 4xx errors reject the entry permanently.
+TRANSIENT_HTTP_CODES = (401, 403, 404, 408, 429)
 
 
 class SendRequest(NamedTuple):
@@ -18,36 +38,93 @@ class SendRequest(NamedTuple):
     entry: bytes
 
 
+class InvalidEntry(ValueError):
+    """The entry cannot be sent to any collection (not JSON, not an object or of unknown kind)."""
+
+
+class SendError(Exception):
+    """
+    Picklable description of an exception raised by a send worker.
+
+    Arango exceptions cannot be unpickled on the forwarder side, so they are replaced by this exception.
+    Errors that are not fatal (network problems, errors reported by the central database) are expected to
+    go away and the request can be retried later, unless they are permanent: the entry itself is invalid or
+    the central database rejected it (e.g. an invalid document), so retrying it would fail again.
+    """
+
+    def __init__(self, description: str, fatal: bool, permanent: bool = False):
+        super().__init__(description, fatal, permanent)
+        self.description = description
+        self.fatal = fatal
+        self.permanent = permanent
+
+    def __str__(self):
+        return self.description
+
+    @staticmethod
+    def from_exception(ex: Exception) -> 'SendError':
+        from arango import ArangoError, ArangoServerError
+
+        if isinstance(ex, InvalidEntry):
+            return SendError("%s: %s" % (type(ex).__name__, ex), fatal=False, permanent=True)
+        # requests' exceptions derive from OSError.
+        fatal = not isinstance(ex, (ArangoError, OSError))
+        http_code = ex.http_code if isinstance(ex, ArangoServerError) else None
+        permanent = http_code is not None and http_code < 500 and http_code not in TRANSIENT_HTTP_CODES
+        return SendError("%s: %s" % (type(ex).__name__, ex), fatal, permanent)
+
+
 class SendResult(NamedTuple):
     entry_id: bytes
-    exception: Optional[Exception]  # 'None' means success
+    exception: Optional[SendError]  # 'None' means success
 
 
 class ArangoParallelLogSender:
     """
     Dispatches LogSystem messages to appropriate ArangoDB collections.
+
+    If sending to an endpoint fails with a network error or a server error (HTTP 5xx), the endpoint is marked
+    unhealthy and the message is sent to another endpoint.
     """
 
-    def __init__(self, work_queue: mp.Queue, result_queue: mp.Queue, work_done: mp.Event):
+    def __init__(self, work_queue: mp.Queue, result_queue: mp.Queue, work_done: mp.Event,
+                 endpoints: Sequence[Endpoint] = DEFAULT_ENDPOINTS, local_region: Optional[str] = None):
         local_logger.info("Log sender started!")
 
-        self.client = ArangoClient(hosts='http://arango-central-db.example:9966')
-        self.logger_db = self.client.db('logging')
-
-        self.scope_starts = self.logger_db.collection('scope_starts')
-        self.scope_ends = self.logger_db.collection('scope_ends')
-        self.threads = self.logger_db.collection('threads')
-        self.messages = self.logger_db.collection('messages')
-        self.qa_traces = self.logger_db.collection('qa_traces')
+        self.router: EndpointRouter['StandardDatabase'] = EndpointRouter(
+            endpoints, self.create_logger_db, self.check_health, local_region=local_region)
 
         self.work_queue = work_queue
         self.result_queue = result_queue
         self.work_done = work_done
 
+        health_thread = threading.Thread(target=self.router.check_health_forever, args=(work_done, ),
+                                         name="log-relay-health-check", daemon=True)
+        health_thread.start()
+
+    def create_client(self, endpoint: Endpoint) -> 'ArangoClient':
+        from arango import ArangoClient
+
+        return ArangoClient(hosts=endpoint.url)
+
+    def create_logger_db(self, endpoint: Endpoint) -> 'StandardDatabase':
+        return self.create_client(endpoint).db('logging')
+
+    @staticmethod
+    def check_health(logger_db: 'StandardDatabase'):
+        logger_db.version()
+
+    @staticmethod
+    def is_endpoint_failure(ex: Exception) -> bool:
+        from arango import ArangoServerError
+
+        # requests' exceptions derive from OSError.
+        return isinstance(ex, OSError) or (isinstance(ex, ArangoServerError) and (ex.http_code or 0) >= 500)
+
     def send(self, entry_id: bytes, entry: bytes):
+        from arango import DocumentInsertError
+
         entry_dict = self.create_message(entry, entry_id)
-        if not entry_dict:
-            return
 
         try:
             self.send_message_ignoring_duplicates(entry_dict)
@@ -60,6 +137,8 @@ class ArangoParallelLogSender:
                 raise
 
     def send_message_ignoring_duplicates(self, entry_dict: Dict) -> None:
+        from arango import DocumentInsertError
+
         try:
             self.dispatch_message(entry_dict)
         except DocumentInsertError as e:
@@ -77,30 +156,56 @@ class ArangoParallelLogSender:
         if 'message' in entry_dict and 'args' in entry_dict:
             entry_dict['args'] = str(entry_dict['args'])
 
-    def create_message(self, entry: bytes, entry_id: bytes) -> Optional[dict]:
+    def create_message(self, entry: bytes, entry_id: bytes) -> dict:
         entry_id_str = entry_id.decode('ascii')
 
         try:
             entry_dict = json.loads(entry.decode('utf8'))
-        except json.decoder.JSONDecodeError:
-            local_logger.exception("Failed to decode message (id=%s): %s. Skipping it", entry_id_str, entry)
-            return None
+        except ValueError as ex:  # JSONDecodeError or UnicodeDecodeError
+            raise InvalidEntry("Failed to decode message (id=%s): %s" % (entry_id_str, ex)) from ex
+        if not isinstance(entry_dict, dict):
+            raise InvalidEntry("Message is not a JSON object (id=%s): %s" % (entry_id_str, type(entry_dict).__name__))
         entry_dict['_key'] = entry_id_str
 
         return entry_dict
 
     def dispatch_message(self, entry_dict: dict):
+        collection_name = self.get_collection_name(entry_dict)
+        tried: List[EndpointState] = []
+        while True:
+            state = self.router.pick(exclude=tried)
+            start_time = time.monotonic()
+            try:
+                state.client.collection(collection_name).insert(entry_dict, silent=True)
+            except Exception as ex:
+                if not self.is_endpoint_failure(ex):
+                    raise
+                self.router.on_failure(state)
+                tried.append(state)
+                if len(tried) >= len(self.router.states):
+                    raise
+                local_logger.warning("Failed to send entry %s to %s, trying another endpoint. Error: %s",
+                                     entry_dict['_key'], state.endpoint.url, ex)
+                continue
+            self.router.on_success(state, time.monotonic() - start_time)
+            return
+
+    @staticmethod
+    def get_collection_name(entry_dict: dict) -> str:
         if 'message' in entry_dict:
-            self.messages.insert(entry_dict, silent=True)
-        elif 'scope_path' in entry_dict:
-            self.scope_starts.insert(entry_dict, silent=True)
-        elif 'end_time' in entry_dict:
-            self.scope_ends.insert(entry_dict, silent=True)
-        elif 'qa_trace_version' in entry_dict:
-            self.qa_traces.insert(entry_dict, silent=True)
-        else:
-            assert 'thread_id' in entry_dict
-            self.threads.insert(entry_dict, silent=True)
+            return 'messages'
+        if 'scope_path' in entry_dict:  # also completed scopes (with 'end_time'), see ScopeCoalescer
+            return 'scope_starts'
+        if 'end_time' in entry_dict:
+            return 'scope_ends'
+        if 'qa_trace_version' in entry_dict:
+            return 'qa_traces'
+        if 'exc_text' in entry_dict:
+            return 'tracebacks'
+        if 'thread_id' not in entry_dict:
+            raise InvalidEntry("Unknown kind of message (id=%s), keys: %s" % (entry_dict.get('_key'),
+                                                                              sorted(entry_dict)))
+        return 'threads'
 
     def handle_request_get_result(self, request: SendRequest) -> SendResult:
         try:
@@ -108,7 +213,7 @@ class ArangoParallelLogSender:
             return SendResult(request.entry_id, exception=None)
         except Exception as ex:
             local_logger.warning("Send worker failed to process request")
-            return SendResult(request.entry_id, exception=ex)
+            return SendResult(request.entry_id, exception=SendError.from_exception(ex))
 
     def serve_forever(self):
         while not self.work_done.is_set():
@@ -123,5 +228,50 @@ class ArangoParallelLogSender:
         local_logger.info("Arango sender finished cleanly.")
 
 
-def arango_sender_thread(work_queue: mp.Queue, result_queue: mp.Queue, work_done: mp.Event):
-    ArangoParallelLogSender(work_queue, result_queue, work_done).serve_forever()
+class PooledArangoLogSender(ArangoParallelLogSender):
+    """
+    Keeps up to `max_in_flight` send requests in flight from a single process.
+
+    Worker threads share one ArangoClient per endpoint, so requests reuse a pool of keep-alive HTTP connections
+    to each endpoint instead of each process holding its own client and connection.
+    """
+
+    def __init__(self, work_queue: mp.Queue, result_queue: mp.Queue, work_done: mp.Event, max_in_flight: int,
+                 endpoints: Sequence[Endpoint] = DEFAULT_ENDPOINTS, local_region: Optional[str] = None):
+        self.max_in_flight = max_in_flight
+        super().__init__(work_queue, result_queue, work_done, endpoints, local_region)
+
+    def create_client(self, endpoint: Endpoint) -> 'ArangoClient':
+        from arango import ArangoClient
+        from arango.http import DefaultHTTPClient
+
+        http_client = DefaultHTTPClient(pool_connections=1, pool_maxsize=self.max_in_flight)
+        return ArangoClient(hosts=endpoint.url, http_client=http_client)
+
+    def put_result(self, future: 'Future[SendResult]'):
+        self.result_queue.put(future.result())
+
+    def serve_forever(self):
+        # Forwarder never submits more than `max_in_flight` requests without awaiting their results,
+        # so the executor's internal queue stays bounded.
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="log-relay-send") as executor:
+            while not self.work_done.is_set():
+                try:
+                    request = self.work_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                future = executor.submit(self.handle_request_get_result, request)
+                future.add_done_callback(self.put_result)
+
+        local_logger.info("Pooled arango sender finished cleanly.")
+
+
+def arango_sender_thread(work_queue: mp.Queue, result_queue: mp.Queue, work_done: mp.Event,
+                         endpoints: Sequence[Endpoint] = DEFAULT_ENDPOINTS, local_region: Optional[str] = None):
+    ArangoParallelLogSender(work_queue, result_queue, work_done, endpoints, local_region).serve_forever()
+
+
+def pooled_arango_sender_thread(work_queue: mp.Queue, result_queue: mp.Queue, work_done: mp.Event, max_in_flight: int,
+                                endpoints: Sequence[Endpoint] = DEFAULT_ENDPOINTS, local_region: Optional[str] = None):
+    PooledArangoLogSender(work_queue, result_queue, work_done, max_in_flight, endpoints, local_region).serve_forever()
@@ -0,0 +1,166 @@
+import argparse
+import datetime
+import json
+import logging
+import sqlite3
+import sys
+import time
+from typing import Dict, List, Optional
+
+from logger.rtbh_log_relay.entries import EntryKind
+from logger.rtbh_log_relay.retention import DEFAULT_RETENTION_PATH
+
+
+def connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect('file:%s?mode=ro' % path, uri=True, timeout=30)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def parse_level(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+    level_no = logging.getLevelName(value.upper())
+    if not isinstance(level_no, int):
+        raise argparse.ArgumentTypeError("unknown level %r" % value)
+    return level_no
+
+
+def build_filters(args: argparse.Namespace):
+    conditions = []
+    params = []
+    for column, value in (('job_name', args.job), ('build_id', args.build), ('thread_uid', args.thread),
+                          ('scope_uid', args.scope)):
+        if value is not None:
+            conditions.append('%s = ?' % column)
+            params.append(value)
+    if args.level is not None:
+        conditions.append('level_no >= ?')
+        params.append(args.level)
+    if args.since is not None:
+        conditions.append('timestamp >= ?')
+        params.append(time.time() - args.since)
+    return conditions, params
+
+
+def format_row(row: sqlite3.Row, as_json: bool) -> str:
+    if as_json:
+        return row['data']
+
+    entry = json.loads(row['data'])
+    timestamp = datetime.datetime.utcfromtimestamp(row['timestamp']).isoformat(sep=' ', timespec='milliseconds')
+    if row['kind'] == EntryKind.log_entry.value:
+        return '%s %-8s %s:%s %s' % (timestamp, entry.get('level'), entry.get('file'), entry.get('line'),
+                                     entry.get('message'))
+    if row['kind'] == EntryKind.scope_start.value:
+        return '%s scope start %s %s' % (timestamp, row['scope_uid'], entry['scope_path'][-1]['name'])
+    if row['kind'] == EntryKind.scope_end.value:
+        return '%s scope end   %s' % (timestamp, row['scope_uid'])
+    return '%s %s %s' % (timestamp, row['kind'], row['data'])
+
+
+def query_entries(connection: sqlite3.Connection, args: argparse.Namespace, min_seq: int = 0,
+                  limit: Optional[int] = None) -> List[sqlite3.Row]:
+    conditions, params = build_filters(args)
+    conditions.append('seq > ?')
+    params.append(min_seq)
+    sql = 'SELECT * FROM entries WHERE %s ORDER BY seq' % ' AND '.join(conditions)
+    if limit is not None:
+        # Most recent `limit` entries, oldest first.
+        sql = 'SELECT * FROM (%s DESC LIMIT %d) ORDER BY seq' % (sql, limit)
+    return connection.execute(sql, params).fetchall()
+
+
+def command_query(connection: sqlite3.Connection, args: argparse.Namespace):
+    for row in query_entries(connection, args, limit=args.limit):
+        print(format_row(row, args.json))
+
+
+def command_tail(connection: sqlite3.Connection, args: argparse.Namespace):
+    rows = query_entries(connection, args, limit=args.limit)
+    last_seq = 0
+    while True:
+        for row in rows:
+            print(format_row(row, args.json), flush=True)
+            last_seq = row['seq']
+        time.sleep(args.interval)
+        rows = query_entries(connection, args, min_seq=last_seq)
+
+
+def command_tree(connection: sqlite3.Connection, args: argparse.Namespace):
+    """Prints scopes of a job as a tree, with durations and numbers of log entries."""
+    scopes: Dict[str, dict] = {}
+    children: Dict[Optional[str], List[str]] = {}
+    for row in connection.execute('SELECT * FROM entries WHERE job_name = ? AND build_id = ? AND kind IN (?, ?) '
+                                  'ORDER BY timestamp',
+                                  (args.job, args.build, EntryKind.scope_start.value, EntryKind.scope_end.value)):
+        entry = json.loads(row['data'])
+        scope = scopes.setdefault(row['scope_uid'], dict(name='?', value=None, start_time=None, end_time=None))
+        if 'scope_path' in entry:
+            scope.update(name=entry['scope_path'][-1]['name'], value=entry['scope_path'][-1]['value'],
+                         start_time=entry['scope_path'][-1]['start_time'])
+            children.setdefault(row['parent_scope_uid'], []).append(row['scope_uid'])
+        if 'end_time' in entry:
+            scope['end_time'] = entry['end_time']
+
+    num_entries = dict(connection.execute(
+        'SELECT scope_uid, COUNT(*) FROM entries WHERE job_name = ? AND build_id = ? AND kind = ? GROUP BY scope_uid',
+        (args.job, args.build, EntryKind.log_entry.value)).fetchall())
+
+    # Scopes whose parents are not retained are shown as roots.
+    roots = [uid for parent, uids in children.items() if parent not in scopes for uid in uids]
+
+    def print_scope(uid: str, depth: int):
+        scope = scopes[uid]
+        if scope['start_time'] is not None and scope['end_time'] is not None:
+            duration = '%.3f s' % (scope['end_time'] - scope['start_time'])
+        else:
+            duration = 'running'
+        value = '(%s)' % scope['value'] if scope['value'] is not None else ''
+        print('%s%s%s [%s, %d entries] %s' % ('  ' * depth, scope['name'], value, duration, num_entries.get(uid, 0), uid))
+        for child in children.get(uid, []):
+            print_scope(child, depth + 1)
+
+    for root in roots:
+        print_scope(root, 0)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Queries entries recently received by the local Log Relay.")
+    parser.add_argument('--db', default=DEFAULT_RETENTION_PATH, help="Path of the relay's retention store.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('query', "Prints matching entries."), ('tail', "Prints matching entries as they arrive.")):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument('--job')
+        subparser.add_argument('--build')
+        subparser.add_argument('--thread', help="Thread uid.")
+        subparser.add_argument('--scope', help="Scope uid.")
+        subparser.add_argument('--level', type=parse_level, help="Minimum level of log entries, e.g. WARNING.")
+        subparser.add_argument('--since', type=float, help="Only entries from the last SINCE seconds.")
+        subparser.add_argument('--limit', type=int, default=100)
+        subparser.add_argument('--json', action='store_true', help="Print entries as JSON documents.")
+        if name == 'tail':
+            subparser.add_argument('--interval', type=float, default=0.5)
+
+    tree_parser = subparsers.add_parser('tree', help="Prints scopes of a job as a tree.")
+    tree_parser.add_argument('--job', required=True)
+    tree_parser.add_argument('--build', required=True)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    connection = connect(args.db)
+    commands = dict(query=command_query, tail=command_tail, tree=command_tree)
+    try:
+        commands[args.command](connection, args)
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        sys.stderr.close()
+
+
+if __name__ == '__main__':
+    main()
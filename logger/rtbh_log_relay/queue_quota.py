@@ -0,0 +1,207 @@
+import collections
+import json
+import threading
+import time
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from logger.rtbh_log_relay.entries import EntryKind, classify_entry
+
+# Levels of log entries that may be evicted, in order of eviction.
+# Other log entries, scope starts/ends and thread descriptions are always retained.
+EVICTABLE_LEVELS = ('DEBUG', 'INFO')
+
+MAX_KNOWN_THREADS = 100000
+
+
+class EvictedEntry(NamedTuple):
+    entry_id: bytes
+    size: int
+    level: str
+    thread_id: str
+
+
+class QueueQuota:
+    """
+    Keeps track of the size of the persistent queue and picks entries to evict when the queue exceeds its quota.
+
+    Entries are indexed at ingest time using `classify_entry`, which does not decode JSON. Only evictable entries
+    are kept in memory (oldest first), other entries only contribute to the totals. Entries being sent stay at their
+    position until they are removed, but are not evicted. Without a quota, only the totals are kept.
+    """
+
+    def __init__(self, max_bytes: int = 0, max_entries: int = 0, low_watermark: float = 0.9,
+                 summary_interval: float = 60.0):
+        """
+        :param max_bytes: Maximum total size of queued entries, 0 means no limit.
+        :param max_entries: Maximum number of queued entries, 0 means no limit.
+        :param low_watermark: Eviction frees space until the queue is below this fraction of the quota.
+        :param summary_interval: Minimum time (seconds) between log entries that summarize evictions.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.low_watermark = low_watermark
+        self.summary_interval = summary_interval
+
+        self.limited = max_bytes > 0 or max_entries > 0
+
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.num_entries = 0
+        self.evictable: Dict[str, 'collections.OrderedDict[bytes, Tuple[int, str]]'] = {
+            level: collections.OrderedDict() for level in EVICTABLE_LEVELS
+        }
+        # Ids of evictable entries that are being sent.
+        self.in_flight: Set[bytes] = set()
+        # thread uid -> (job_name, build_id), learned from thread descriptions.
+        self.thread_jobs: 'collections.OrderedDict[str, Tuple[str, str]]' = collections.OrderedDict()
+        # job (or thread) -> summary of entries evicted since summaries were last taken.
+        self.eviction_summaries: Dict[Tuple, dict] = {}
+        self.last_summary_time = time.monotonic()
+
+    def add(self, entry_id: bytes, data: bytes):
+        if not self.limited:
+            with self.lock:
+                self.total_bytes += len(data)
+                self.num_entries += 1
+            return
+
+        info = classify_entry(data)
+        with self.lock:
+            if info.kind == EntryKind.thread:
+                self.remember_thread(data)
+            self.total_bytes += len(data)
+            self.num_entries += 1
+            if info.level in self.evictable:
+                self.evictable[info.level][entry_id] = (len(data), info.thread_id)
+
+    def claim(self, entry_id: bytes, data: bytes) -> bool:
+        """
+        Protects an entry that is about to be sent from eviction, until it is removed or released.
+        Returns False if the entry was evicted in the meantime.
+        """
+        if not self.limited:
+            return True
+
+        info = classify_entry(data)
+        with self.lock:
+            if info.level in self.evictable:
+                if entry_id not in self.evictable[info.level]:
+                    return False
+                self.in_flight.add(entry_id)
+            return True
+
+    def release(self, entry_id: bytes):
+        """Makes a claimed entry that stays queued (e.g. sending failed) evictable again, at its original position."""
+        with self.lock:
+            self.in_flight.discard(entry_id)
+
+    def remove(self, entry_id: bytes, data: bytes):
+        """Removes an entry that was deleted from the queue (e.g. sent)."""
+        info = classify_entry(data) if self.limited else None
+        with self.lock:
+            self.total_bytes -= len(data)
+            self.num_entries -= 1
+            if info is not None and info.level in self.evictable:
+                self.evictable[info.level].pop(entry_id, None)
+                self.in_flight.discard(entry_id)
+
+    def over_quota(self) -> bool:
+        return (0 < self.max_bytes < self.total_bytes) or (0 < self.max_entries < self.num_entries)
+
+    def usage(self) -> float:
+        """Returns the fraction of the quota that is used (the higher of the two limits), 0 if there is no quota."""
+        usage = 0.0
+        if self.max_bytes > 0:
+            usage = max(usage, self.total_bytes / self.max_bytes)
+        if self.max_entries > 0:
+            usage = max(usage, self.num_entries / self.max_entries)
+        return usage
+
+    def pick_entries_to_evict(self) -> List[EvictedEntry]:
+        """
+        Removes the least valuable entries from the index until the queue is below the low watermark.
+        The caller is responsible for deleting returned entries from the queue.
+        """
+        evicted = []
+        with self.lock:
+            for level in EVICTABLE_LEVELS:
+                entries = self.evictable[level]
+                skipped = []
+                while entries and self.above_low_watermark():
+                    entry_id, (size, thread_id) = entries.popitem(last=False)
+                    if entry_id in self.in_flight:
+                        skipped.append((entry_id, (size, thread_id)))
+                        continue
+                    self.total_bytes -= size
+                    self.num_entries -= 1
+                    evicted.append(EvictedEntry(entry_id, size, level, thread_id))
+                # Entries being sent are the oldest ones, they go back to the front.
+                for entry_id, value in reversed(skipped):
+                    entries[entry_id] = value
+                    entries.move_to_end(entry_id, last=False)
+        return evicted
+
+    def above_low_watermark(self) -> bool:
+        return ((self.max_bytes > 0 and self.total_bytes > self.max_bytes * self.low_watermark)
+                or (self.max_entries > 0 and self.num_entries > self.max_entries * self.low_watermark))
+
+    def remember_thread(self, data: bytes):
+        try:
+            thread_dict = json.loads(data.decode('utf8'))
+            self.thread_jobs[thread_dict['uid']] = (thread_dict['job_name'], thread_dict['build_id'])
+        except (ValueError, KeyError, TypeError):
+            return
+        while len(self.thread_jobs) > MAX_KNOWN_THREADS:
+            self.thread_jobs.popitem(last=False)
+
+    def record_evictions(self, evicted: List[EvictedEntry]):
+        """
+        Adds evicted entries to running summaries (one per job_name/build_id, or per thread if its job is unknown).
+        Summaries are sent by `take_eviction_summaries`.
+        """
+        time_now = time.time()
+        with self.lock:
+            for entry in evicted:
+                job = self.thread_jobs.get(entry.thread_id)
+                group_key = job if job is not None else ('thread', entry.thread_id)
+                group = self.eviction_summaries.get(group_key)
+                if group is None:
+                    group = self.eviction_summaries[group_key] = dict(
+                        thread_id=entry.thread_id, job=job, num_bytes=0, levels=collections.Counter(),
+                        first_time=time_now)
+                group['num_bytes'] += entry.size
+                group['levels'][entry.level] += 1
+                group['last_time'] = time_now
+
+    def take_eviction_summaries(self) -> List[bytes]:
+        """
+        Returns synthetic log entries that record how many entries were evicted, at most once per `summary_interval`.
+        Returned entries are meant to be queued, so they count against the quota, but there are at most as many of
+        them per interval as there are jobs (or threads of unknown jobs) with evicted entries.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if not self.eviction_summaries or now - self.last_summary_time < self.summary_interval:
+                return []
+            self.last_summary_time = now
+            summaries, self.eviction_summaries = self.eviction_summaries, {}
+
+        result = []
+        for group in summaries.values():
+            job_name, build_id = group['job'] if group['job'] is not None else (None, None)
+            args = dict(job_name=job_name, build_id=build_id, evicted_entries=dict(group['levels']),
+                        evicted_bytes=group['num_bytes'], first_eviction_time=group['first_time'],
+                        last_eviction_time=group['last_time'])
+            entry_dict = dict(
+                thread_id=group['thread_id'],
+                scope_id=None,
+                timestamp=group['last_time'],
+                level='WARNING',
+                file='rtbh_log_relay',
+                line=0,
+                message="Log relay queue exceeded its quota, evicted %d entries (%d bytes)"
+                        % (sum(group['levels'].values()), group['num_bytes']),
+                args=args,
+            )
+            result.append(json.dumps(entry_dict).encode('utf8'))
+        return result
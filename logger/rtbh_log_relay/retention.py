@@ -0,0 +1,197 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from logger.rtbh_log_relay import local_logger
+from logger.rtbh_log_relay.entries import EntryKind, classify_entry
+
+DEFAULT_RETENTION_PATH = '/tmp/rtbh-log-relay-retention.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    entry_id TEXT NOT NULL UNIQUE,
+    received_time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    job_name TEXT,
+    build_id TEXT,
+    thread_uid TEXT,
+    scope_uid TEXT,
+    parent_scope_uid TEXT,
+    level_no INTEGER,
+    timestamp REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_job ON entries (job_name, build_id);
+CREATE INDEX IF NOT EXISTS entries_thread ON entries (thread_uid);
+CREATE INDEX IF NOT EXISTS entries_scope ON entries (scope_uid);
+CREATE INDEX IF NOT EXISTS entries_level ON entries (level_no);
+CREATE INDEX IF NOT EXISTS entries_received_time ON entries (received_time);
+"""
+
+MAX_KNOWN_THREADS = 100000
+# Entries written by the writer thread in a single transaction.
+MAX_WRITE_BATCH = 1000
+
+
+class RetentionStore:
+    """
+    Keeps recently received entries in a local SQLite database, indexed by job_name/build_id, thread uid,
+    scope uid and level, so they can be queried on the host (see logger/log_relay_query.py).
+
+    Entries are written when they are received, before they are sent to the central database, so they can be
+    queried even when the central database is not reachable. They are pruned after `max_age` seconds.
+    Thread descriptions are kept as long as there are entries of their threads.
+
+    Received entries are only queued by `add_entries`, a single writer thread writes them in batches and prunes
+    the store, so connection handler threads never wait for SQLite. If more than `max_queued` entries wait to be
+    written, new entries are not retained.
+    """
+
+    def __init__(self, path: str = DEFAULT_RETENTION_PATH, max_age: float = 3600.0, prune_interval: float = 60.0,
+                 max_queued: int = 100000):
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self.last_prune_time = 0.0
+
+        # Used only by the writer thread, after it is created here.
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        # thread uid -> (job_name, build_id), log entries do not carry their job.
+        self.thread_jobs: Dict[str, Tuple[str, str]] = {}
+
+        # Tuples (entry_id, entry, received_time).
+        self.pending: 'queue.Queue[Tuple[bytes, bytes, float]]' = queue.Queue(maxsize=max_queued)
+        self.num_dropped = 0
+        self.last_drop_warning_time = 0.0
+
+        writer_thread = threading.Thread(target=self.write_forever, name="log-relay-retention-writer", daemon=True)
+        writer_thread.start()
+
+    def add_entries(self, entries: List[Tuple[bytes, bytes]]):
+        """
+        Queues entries to be written by the writer thread, never blocks.
+
+        :param entries: list of tuples (entry_id, entry).
+        """
+        received_time = time.time()
+        for entry_id, data in entries:
+            try:
+                self.pending.put_nowait((entry_id, data, received_time))
+            except queue.Full:
+                self.num_dropped += 1  # not exact, only reported
+
+        if self.num_dropped:
+            now = time.monotonic()
+            if now - self.last_drop_warning_time > 60:
+                self.last_drop_warning_time = now
+                local_logger.warning("Retention store cannot keep up, %d entries were not retained", self.num_dropped)
+                self.num_dropped = 0
+
+    def write_forever(self):
+        while True:
+            entries = [self.pending.get()]
+            while len(entries) < MAX_WRITE_BATCH:
+                try:
+                    entries.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_entries(entries)
+            except Exception:  # pylint: disable=broad-except
+                # The store is only a debugging aid, the writer must keep going.
+                local_logger.exception("Failed to add %d entries to the retention store", len(entries))
+
+    def write_entries(self, entries: List[Tuple[bytes, bytes, float]]):
+        """
+        :param entries: list of tuples (entry_id, entry, received_time).
+        """
+        classified = [(entry_id, data, classify_entry(data).kind, received_time)
+                      for entry_id, data, received_time in entries]
+        # Thread descriptions go first, so that log entries sent in the same batch can be assigned to their jobs.
+        classified.sort(key=lambda item: item[2] != EntryKind.thread)
+        rows = []
+        for entry_id, data, kind, received_time in classified:
+            row = self.create_row(entry_id, data, kind, received_time)
+            if row is not None:
+                rows.append(row)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO entries (entry_id, received_time, kind, job_name, build_id, thread_uid, "
+                "scope_uid, parent_scope_uid, level_no, timestamp, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        now = time.time()
+        if now - self.last_prune_time > self.prune_interval:
+            self.last_prune_time = now
+            self.prune(now - self.max_age)
+
+    def create_row(self, entry_id: bytes, data: bytes, kind: EntryKind, received_time: float) -> Optional[tuple]:
+        try:
+            entry = json.loads(data.decode('utf8'))
+        except ValueError:
+            return None
+
+        job_name = entry.get('job_name')
+        build_id = entry.get('build_id')
+        thread_uid = scope_uid = parent_scope_uid = level_no = None
+        timestamp = received_time
+
+        if kind == EntryKind.log_entry:
+            thread_uid = entry.get('thread_id')
+            scope_uid = entry.get('scope_id')
+            job_name, build_id = self.get_thread_job(thread_uid)
+            level_no = logging.getLevelName(entry.get('level'))
+            if not isinstance(level_no, int):
+                level_no = None
+            timestamp = entry.get('timestamp', received_time)
+        elif kind == EntryKind.thread:
+            thread_uid = entry.get('uid')
+            self.remember_thread(thread_uid, job_name, build_id)
+        elif kind in (EntryKind.scope_start, EntryKind.scope_end):
+            scope_uid = entry.get('uid')
+            scope_path = entry.get('scope_path') or []
+            if len(scope_path) >= 2:
+                parent_scope_uid = scope_path[-2]['uid']
+            if scope_path:
+                timestamp = scope_path[-1]['start_time']
+            else:
+                timestamp = entry.get('end_time', received_time)
+
+        return (entry_id.decode('ascii'), received_time, kind.value, job_name, build_id, thread_uid, scope_uid,
+                parent_scope_uid, level_no, timestamp, data.decode('utf8'))
+
+    def remember_thread(self, thread_uid: str, job_name: str, build_id: str):
+        if len(self.thread_jobs) >= MAX_KNOWN_THREADS:
+            self.thread_jobs.clear()
+        self.thread_jobs[thread_uid] = (job_name, build_id)
+
+    def get_thread_job(self, thread_uid: str) -> Tuple[Optional[str], Optional[str]]:
+        job = self.thread_jobs.get(thread_uid)
+        if job is None:
+            row = self.connection.execute(
+                "SELECT job_name, build_id FROM entries WHERE kind = ? AND thread_uid = ? LIMIT 1",
+                (EntryKind.thread.value, thread_uid)).fetchone()
+            if row is None:
+                return None, None
+            job = row
+            self.remember_thread(thread_uid, *job)
+        return job
+
+    def prune(self, min_received_time: float):
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM entries WHERE received_time < ? AND kind != ?",
+                (min_received_time, EntryKind.thread.value))
+            self.connection.execute(
+                "DELETE FROM entries WHERE received_time < ? AND kind = ? AND thread_uid NOT IN "
+                "(SELECT thread_uid FROM entries WHERE kind = ? AND thread_uid IS NOT NULL)",
+                (min_received_time, EntryKind.thread.value, EntryKind.log_entry.value))
+        if cursor.rowcount > 0:
+            local_logger.info("Pruned %d entries from the retention store", cursor.rowcount)
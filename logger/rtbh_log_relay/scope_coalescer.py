@@ -0,0 +1,76 @@
+import collections
+import json
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from logger.rtbh_log_relay.entries import scope_uid
+
+
+class PendingScope(NamedTuple):
+    entry_id: bytes
+    data: bytes
+    deadline: float
+
+
+class ScopeCoalescer:
+    """
+    Holds scope starts for a short time, so that a start and a matching end can be sent as a single document.
+
+    A completed scope is a scope start message with `end_time` (and other fields of the scope end) merged in,
+    so it is stored in `scope_starts` and nothing is stored in `scope_ends`.
+
+    Held starts are already stored in the persistent queue, they are only not sent yet. Starts that did not end within
+    `window` seconds, or that do not fit in the table of `max_pending` scopes, are released and sent unchanged.
+    """
+
+    def __init__(self, window: float = 1.0, max_pending: int = 10000):
+        self.window = window
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending: 'collections.OrderedDict[str, PendingScope]' = collections.OrderedDict()
+
+    def hold_start(self, entry_id: bytes, data: bytes) -> List[bytes]:
+        """
+        Holds a scope start. Returns ids of entries that have to be sent right away.
+        """
+        uid = scope_uid(data)
+        if uid is None:
+            return [entry_id]
+
+        released = []
+        with self.lock:
+            self.pending[uid] = PendingScope(entry_id, data, time.monotonic() + self.window)
+            while len(self.pending) > self.max_pending:
+                _, oldest = self.pending.popitem(last=False)
+                released.append(oldest.entry_id)
+        return released
+
+    def complete(self, end_data: bytes) -> Optional[Tuple[PendingScope, bytes]]:
+        """
+        Returns a tuple (held_scope_start, completed_scope) if the start of the ending scope is held, None otherwise.
+        """
+        uid = scope_uid(end_data)
+        with self.lock:
+            start = self.pending.pop(uid, None)
+        if start is None:
+            return None
+
+        completed = json.loads(start.data.decode('utf8'))
+        completed.update(json.loads(end_data.decode('utf8')))
+        return start, json.dumps(completed).encode('utf8')
+
+    def release_expired(self) -> List[bytes]:
+        """
+        Returns ids of held scope starts whose window has passed.
+        """
+        now = time.monotonic()
+        released = []
+        with self.lock:
+            while self.pending:
+                uid, oldest = next(iter(self.pending.items()))
+                if oldest.deadline > now:
+                    break
+                del self.pending[uid]
+                released.append(oldest.entry_id)
+        return released
@@ -0,0 +1,82 @@
+import os
+import time
+from typing import List
+
+from logger.rtbh_log_relay import local_logger
+from logger.rtbh_log_relay.forwarder import ParallelLogForwarder
+from logger.segment_sender import OPEN_SEGMENT_SUFFIX, SEGMENT_SUFFIX, read_segment
+
+
+class SegmentIngester:
+    """
+    Bulk-ingests segment files written by SegmentLogSender into the forwarder's persistent queue.
+
+    Completed segments are ingested and deleted. Segments left open by processes that no longer exist
+    (e.g. killed jobs) are ingested as well; records after the last complete one are ignored.
+    """
+
+    def __init__(self, segment_dir: str, forwarder: ParallelLogForwarder, interval: float = 1.0,
+                 batch_size: int = 10000):
+        self.segment_dir = segment_dir
+        self.forwarder = forwarder
+        self.interval = interval
+        self.batch_size = batch_size
+
+    def ingest_forever(self):
+        while True:
+            try:
+                self.ingest_segments()
+            except Exception:  # pylint: disable=broad-except
+                local_logger.exception("Failed to ingest segments from %s", self.segment_dir)
+            time.sleep(self.interval)
+
+    def ingest_segments(self) -> int:
+        num_entries = 0
+        for path in self.find_segments():
+            num_entries += self.ingest_segment(path)
+        return num_entries
+
+    def find_segments(self) -> List[str]:
+        try:
+            names = sorted(os.listdir(self.segment_dir))
+        except FileNotFoundError:
+            return []
+
+        result = []
+        for name in names:
+            if name.endswith(SEGMENT_SUFFIX):
+                result.append(os.path.join(self.segment_dir, name))
+            elif name.endswith(OPEN_SEGMENT_SUFFIX) and not self.is_writer_alive(name):
+                result.append(os.path.join(self.segment_dir, name))
+        return result
+
+    @staticmethod
+    def is_writer_alive(name: str) -> bool:
+        try:
+            pid = int(name.split('-', 1)[0])
+            os.kill(pid, 0)
+        except (ValueError, ProcessLookupError):
+            return False
+        except PermissionError:
+            pass  # process exists, but belongs to another user
+        return True
+
+    def ingest_segment(self, path: str) -> int:
+        start_time = time.monotonic()
+        num_entries = 0
+        batch = []
+        for entry in read_segment(path):
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self.forwarder.entries_received(batch)
+                num_entries += len(batch)
+                batch = []
+        if batch:
+            self.forwarder.entries_received(batch)
+            num_entries += len(batch)
+
+        # Entries are already in the persistent queue. If the relay dies before the segment is removed,
+        # the segment is ingested again and its entries are duplicated.
+        os.unlink(path)
+        local_logger.info("Ingested %d entries from %s in %.2f s", num_entries, path, time.monotonic() - start_time)
+        return num_entries
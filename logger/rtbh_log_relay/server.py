@@ -8,10 +8,24 @@ from logger.rtbh_log_relay import local_logger
 from logger.rtbh_log_relay.forwarder import ParallelLogForwarder
 
 V2_ACK_BYTES = bytes([0x55])
+REJECT_BYTES = bytes([0xEE])
+
+HEADER = struct.Struct('<ii')
+CHUNK_HEADER = struct.Struct('<i')
+
+DEFAULT_MAX_ENTRY_SIZE = 64 * 1024 * 1024
+INITIAL_BUFFER_SIZE = 64 * 1024
 
 
 class ProtocolVersion(enum.Enum):
     v2 = 2
+    v3 = 3
+    v4 = 4  # v2 with backpressure level in replies
+    v5 = 5  # v3 with backpressure level in replies
+
+
+# Versions whose replies are followed by a backpressure level byte.
+FLOW_CONTROL_VERSIONS = (ProtocolVersion.v4, ProtocolVersion.v5)
 
 
 class RequestHandler(socketserver.BaseRequestHandler):
@@ -32,62 +46,154 @@ class RequestHandler(socketserver.BaseRequestHandler):
         - message body.
         Each message is acknowledged by sending a single byte reply with value
         0x55.
+
+    Protocol version v3 (ProtocolVersion.v3), used for large messages:
+        - message size (4 bytes int, little endian, equals -1, the size is not known up front),
+        - protocol version (4 bytes int, little endian, equals 3),
+        - chunks: chunk size (4 bytes int, little endian, positive) followed by chunk data,
+        - chunk size 0 that marks the end of the message.
+        Messages are acknowledged as in v2.
+
+    Protocol versions v4 and v5 (ProtocolVersion.v4, ProtocolVersion.v5) are
+    v2 and v3 respectively, with each reply (0x55 or 0xEE) followed by a single
+    byte with the backpressure level of the relay: 0 if the relay keeps up,
+    higher values the more its queue is overloaded (see
+    ParallelLogForwarder.backpressure_level). Clients are expected to send less
+    (e.g. drop DEBUG and INFO entries) until the level drops back to 0.
+
+    Messages larger than the server's `max_entry_size` are read and dropped, and
+    a single byte reply with value 0xEE is sent instead of the acknowledgement.
+
+    Messages are read into a buffer that is reused by consecutive messages of
+    a connection, and are passed to the forwarder as memoryviews of this buffer.
+    A buffer grown for a large message is released after the message is handled.
     """
 
     class Frame(NamedTuple):
-        data: bytes
+        data: Optional[memoryview]  # None if the message was too large
         proto_version: ProtocolVersion
 
+    def setup(self):
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+
     def handle(self):
         while True:
             frame = self.read_frame()
             if frame is None:
                 break
             entry, proto_version = frame
-            assert proto_version == ProtocolVersion.v2
+            if entry is None:
+                self.reject_frame(proto_version)
+                continue
             self.server.forwarder.entry_received(entry)
-            self.ack_frame_v2()
+            self.ack_frame(proto_version)
+            if len(self.buffer) > INITIAL_BUFFER_SIZE:
+                # Large messages are rare, the buffer must not keep their size for the lifetime of the connection.
+                self.buffer = bytearray(INITIAL_BUFFER_SIZE)
 
     def read_frame(self) -> Optional['RequestHandler.Frame']:
         """
         Returns a tuple (message_body, protocol_version) or None if the connection
         was closed.
         """
-        size_buffer = self.read_buffer(4)
-        if size_buffer is None:
+        header = self.read_buffer(HEADER.size)
+        if header is None:
+            return None
+        data_size, proto_version = HEADER.unpack(header)
+        if data_size >= 0:
+            local_logger.warning("Unsupported legacy protocol (message size %d), closing connection", data_size)
             return None
-        data_size = struct.unpack('<i', size_buffer)[0]
-        assert data_size != 0
 
-        return self.read_body_v2(data_size_negative=data_size)
+        proto_version = ProtocolVersion(proto_version)
+        if proto_version in (ProtocolVersion.v3, ProtocolVersion.v5):
+            return self.read_body_v3(proto_version)
+        return self.read_body_v2(data_size_negative=data_size, proto_version=proto_version)
 
-    def read_body_v2(self, data_size_negative: int) -> Optional['RequestHandler.Frame']:
+    def read_body_v2(self, data_size_negative: int,
+                     proto_version: ProtocolVersion = ProtocolVersion.v2) -> Optional['RequestHandler.Frame']:
         data_size = -data_size_negative
 
-        proto_version_buffer = self.read_buffer(4)
-        if proto_version_buffer is None:
-            return None
-        proto_version = struct.unpack('<i', proto_version_buffer)[0]
+        if data_size > self.server.max_entry_size:
+            local_logger.warning("Dropping message of %d bytes (max entry size %d)",
+                                 data_size, self.server.max_entry_size)
+            if not self.skip_bytes(data_size):
+                return None
+            return self.Frame(None, proto_version)
 
         data_buffer = self.read_buffer(data_size)
         if data_buffer is None:
             return None
 
-        return self.Frame(data_buffer, ProtocolVersion(proto_version))
+        return self.Frame(data_buffer, proto_version)
+
+    def read_body_v3(self, proto_version: ProtocolVersion = ProtocolVersion.v3) -> Optional['RequestHandler.Frame']:
+        data_size = 0
+        too_large = False
+
+        while True:
+            chunk_header = self.read_buffer(CHUNK_HEADER.size, offset=data_size)
+            if chunk_header is None:
+                return None
+            chunk_size = CHUNK_HEADER.unpack(chunk_header)[0]
+            if chunk_size == 0:
+                break
+            assert chunk_size > 0
 
-    def read_buffer(self, size: int) -> Optional[bytes]:
-        all_data = b''
+            if too_large or data_size + chunk_size > self.server.max_entry_size:
+                too_large = True
+                if not self.skip_bytes(chunk_size):
+                    return None
+                continue
 
-        while len(all_data) < size:
-            data = self.request.recv(size - len(all_data))
-            if len(data) == 0:
+            if self.read_buffer(chunk_size, offset=data_size) is None:
                 return None
-            all_data += data
+            data_size += chunk_size
+
+        if too_large:
+            local_logger.warning("Dropping chunked message larger than %d bytes", self.server.max_entry_size)
+            return self.Frame(None, proto_version)
+        return self.Frame(memoryview(self.buffer)[:data_size], proto_version)
+
+    def read_buffer(self, size: int, offset: int = 0) -> Optional[memoryview]:
+        """
+        Reads exactly `size` bytes into the buffer at `offset`. Returns a view of read bytes, valid until the next read,
+        or None if the connection was closed.
+        """
+        if offset + size > len(self.buffer):
+            # Views of the old buffer may still exist, so it cannot be resized in place.
+            new_buffer = bytearray(max(offset + size, 2 * len(self.buffer)))
+            new_buffer[:offset] = memoryview(self.buffer)[:offset]
+            self.buffer = new_buffer
+
+        view = memoryview(self.buffer)[offset:offset + size]
+        num_read = 0
+        while num_read < size:
+            num_read_now = self.request.recv_into(view[num_read:])
+            if num_read_now == 0:
+                return None
+            num_read += num_read_now
+
+        return view
+
+    def skip_bytes(self, size: int) -> bool:
+        """Reads and drops `size` bytes. Returns False if the connection was closed."""
+        while size > 0:
+            skipped = self.read_buffer(min(size, len(self.buffer)))
+            if skipped is None:
+                return False
+            size -= len(skipped)
+        return True
+
+    def ack_frame(self, proto_version: ProtocolVersion):
+        self.request.sendall(V2_ACK_BYTES + self.backpressure_bytes(proto_version))
 
-        return all_data
+    def reject_frame(self, proto_version: ProtocolVersion):
+        self.request.sendall(REJECT_BYTES + self.backpressure_bytes(proto_version))
 
-    def ack_frame_v2(self):
-        self.request.sendall(V2_ACK_BYTES)
+    def backpressure_bytes(self, proto_version: ProtocolVersion) -> bytes:
+        if proto_version not in FLOW_CONTROL_VERSIONS:
+            return b''
+        return bytes([self.server.forwarder.backpressure_level()])
 
 
 class LocalLogServer(socketserver.ThreadingUnixStreamServer):
@@ -95,7 +201,7 @@ class LocalLogServer(socketserver.ThreadingUnixStreamServer):
     Unix domain server that uses RequestHandler and LogForwarder to relay messages.
     """
 
-    def __init__(self, server_address, forwarder: ParallelLogForwarder):
+    def __init__(self, server_address, forwarder: ParallelLogForwarder, max_entry_size: int = DEFAULT_MAX_ENTRY_SIZE):
         self.daemon_threads = True
         try:
             os.unlink(server_address)
@@ -106,4 +212,5 @@ class LocalLogServer(socketserver.ThreadingUnixStreamServer):
         super().__init__(server_address, RequestHandler)
         os.chmod(server_address, 0o777)
         self.forwarder = forwarder
+        self.max_entry_size = max_entry_size
         local_logger.info("Accepting connections")
@@ -1,11 +1,8 @@
-import inspect
 import logging
 import os
-import socket
 import sys
 import threading
 import time
-import uuid
 from contextlib import contextmanager
 from typing import List, Optional, Tuple, TypeVar, Union
 
@@ -19,18 +16,41 @@ from logger.structs import (
     ScopeEndMessage,
     ScopeStartMessage,
     ThreadDescription,
+    TracebackMessage,
     Uid,
 )
+from logger.scope_metrics import ScopeMetrics
+from logger.scope_profiler import ScopeProfile, should_profile
+from logger.tracebacks import Occurrence, TracebackRegistry, traceback_fingerprint
 
 T = TypeVar("T")
 
 
 class LoggerThreadLocal(threading.local):
+    CONTEXT_ATTRIBUTES = ('thread_desc', 'thread_desc_sent', 'logical_scopes', 'scope_metrics', 'scope_profiles',
+                          'inherited_scope_uids')
+
     def __init__(self, unsafe_process_scope_id: Optional[str] = None):  # pylint: disable=super-init-not-called
         """
+        Context of a thread is created on its first use (first log entry or scope), not when this object is created.
+
         :param unsafe_process_scope_id: Replaces parent scope with this value. Do not use unless you know EXACTLY what
         you are doing.
         """
+        self.__dict__['unsafe_process_scope_id'] = unsafe_process_scope_id
+
+    def __getattr__(self, name):
+        # Called only for attributes that are not set yet.
+        if name not in LoggerThreadLocal.CONTEXT_ATTRIBUTES:
+            raise AttributeError(name)
+        self.create_context()
+        return self.__dict__[name]
+
+    def create_context(self):
+        # socket and uuid are imported on first use to keep `import logger` fast.
+        import socket  # pylint: disable=import-outside-toplevel
+        import uuid  # pylint: disable=import-outside-toplevel
+
         process_name = sys.argv[0][::-1].replace("yp.", "")[::-1]
         hostname = socket.gethostname()
 
@@ -48,11 +68,17 @@ class LoggerThreadLocal(threading.local):
                                                          uid=str(uuid.uuid4()))
         self.__dict__['thread_desc_sent'] = False
         logical_scopes = []
-        process_scope_id = unsafe_process_scope_id or os.getenv("RTBH_LOGGER_SCOPE_ID")
+        process_scope_id = self.__dict__['unsafe_process_scope_id'] or os.getenv("RTBH_LOGGER_SCOPE_ID")
         if process_scope_id:
             logical_scopes.append(LogicalScope(job_name=job_name, build_id=build_id,
                                                uid=process_scope_id, name='<inherited>', value=None, start_time=time.time()))
         self.__dict__['logical_scopes'] = logical_scopes
+        # scope uid -> ScopeMetrics, created when the first metric is recorded in a scope.
+        self.__dict__['scope_metrics'] = {}
+        # scope uid -> ScopeProfile, for scopes selected for profiling.
+        self.__dict__['scope_profiles'] = {}
+        # uids of scopes set by inherited_scopes() or inherited by the process, they end in another thread or process.
+        self.__dict__['inherited_scope_uids'] = frozenset([process_scope_id] if process_scope_id else [])
 
 
 _logger_context = LoggerThreadLocal()
@@ -63,11 +89,17 @@ class LoggerScopeDecorator:
     """
     Calling decorated function will create new logger scope, nested inside parent scope.
     """
+    # Created on first use by get_log_sender(), unless set explicitly.
     log_sender: LogSender = None
 
-    def __init__(self, name=None, key=None):
+    def __init__(self, name=None, key=None, profile_sample_rate: Optional[float] = None):
+        """
+        :param profile_sample_rate: Fraction of calls whose CPU time, wall time and allocations are recorded,
+        see logger.scope_profiler. Defaults to RTBH_LOGGER_PROFILE_SAMPLE_RATE env variable (0 if not set).
+        """
         self.name = name
         self.key = key
+        self.profile_sample_rate = profile_sample_rate
 
     def __call__(self, fun: T) -> T:
         if self.name is None:
@@ -75,13 +107,15 @@ class LoggerScopeDecorator:
 
         def wrapped_f(*args, **kwargs):
             if self.key:
+                import inspect  # pylint: disable=import-outside-toplevel
+
                 bound_args = inspect.signature(fun).bind(*args, **kwargs)
                 bound_args.apply_defaults()
                 key_value = str(bound_args.arguments[self.key])
             else:
                 key_value = None
 
-            LoggerScopeDecorator.enter_scope(self.name, key_value)
+            LoggerScopeDecorator.enter_scope(self.name, key_value, self.profile_sample_rate)
             try:
                 result = fun(*args, **kwargs)
             finally:
@@ -91,26 +125,39 @@ class LoggerScopeDecorator:
         return wrapped_f
 
     @staticmethod
-    def enter_scope(scope_name, key_value):
+    def enter_scope(scope_name, key_value, profile_sample_rate: Optional[float] = None):
+        import uuid  # pylint: disable=import-outside-toplevel
+
         uid = str(uuid.uuid4())
         thread_desc = _logger_context.thread_desc
         scope = LogicalScope(job_name=thread_desc.job_name, build_id=thread_desc.build_id,
                              uid=uid, name=scope_name, value=key_value, start_time=time.time())
         _logger_context.logical_scopes.append(scope)
-        LoggerScopeDecorator.log_sender.send_entries(create_scope_start_message())
+        get_log_sender().send_entries(create_scope_start_message())
+        if should_profile(profile_sample_rate):
+            # Started after the start message is sent, so that sending it is not included.
+            _logger_context.scope_profiles[uid] = ScopeProfile(profile_sample_rate)
 
     @staticmethod
     def leave_scope():
-        LoggerScopeDecorator.log_sender.send_entries(create_scope_end_message())
+        get_log_sender().send_entries(create_scope_end_message())
         _logger_context.logical_scopes.pop()
 
 
+def get_log_sender() -> LogSender:
+    if LoggerScopeDecorator.log_sender is None:
+        from logger.sender import LocalLogSender  # pylint: disable=import-outside-toplevel
+
+        LoggerScopeDecorator.log_sender = LocalLogSender()
+    return LoggerScopeDecorator.log_sender
+
+
 @contextmanager
-def manual_scope(scope_name: str, scope_value=None):
+def manual_scope(scope_name: str, scope_value=None, profile_sample_rate: Optional[float] = None):
     """Contextmanager that behaves like LoggerScopeDecorator."""
 
     key_value = str(scope_value) if scope_value is not None else None
-    LoggerScopeDecorator.enter_scope(scope_name, key_value)
+    LoggerScopeDecorator.enter_scope(scope_name, key_value, profile_sample_rate)
     try:
         yield
     finally:
@@ -118,14 +165,14 @@ def manual_scope(scope_name: str, scope_value=None):
 
 
 class ScopeWithValueDecorator(LoggerScopeDecorator):
-    def __init__(self, value=None):
+    def __init__(self, value=None, profile_sample_rate: Optional[float] = None):
         """Uses argument named `value` as a scope value."""
-        LoggerScopeDecorator.__init__(self, None, value)
+        LoggerScopeDecorator.__init__(self, None, value, profile_sample_rate)
 
 
 class NamedScopeDecorator(LoggerScopeDecorator):
-    def __init__(self, name, value=None):
-        LoggerScopeDecorator.__init__(self, name, value)
+    def __init__(self, name, value=None, profile_sample_rate: Optional[float] = None):
+        LoggerScopeDecorator.__init__(self, name, value, profile_sample_rate)
 
 
 def new_scope(fun: T) -> T:
@@ -162,25 +209,104 @@ def get_current_scope_id() -> Optional[Uid]:
     return None
 
 
-def maybe_add_exc_text_to_args_and_msg(
+def get_scope_chain() -> List[LogicalScope]:
+    """Returns scopes of the current thread, outermost first."""
+    # pylint: disable=no-member
+    return list(_logger_context.logical_scopes)
+
+
+@contextmanager
+def inherited_scopes(scope_chain: List[LogicalScope]):
+    """
+    Contextmanager that makes `scope_chain` (captured with get_scope_chain(), possibly in another thread or process)
+    the scopes of the current thread. Scope starts are not sent again, so log entries and new scopes are attached
+    to the existing scope tree. Metrics cannot be recorded in inherited scopes (see current_scope_metrics()).
+    """
+    # pylint: disable=no-member
+    previous_scopes = _logger_context.logical_scopes
+    previous_inherited_uids = _logger_context.inherited_scope_uids
+    inherited_uids = frozenset(scope.uid for scope in scope_chain)
+    _logger_context.__dict__['logical_scopes'] = list(scope_chain)
+    _logger_context.__dict__['inherited_scope_uids'] = previous_inherited_uids | inherited_uids
+    try:
+        yield
+    finally:
+        _logger_context.__dict__['logical_scopes'] = previous_scopes
+        _logger_context.__dict__['inherited_scope_uids'] = previous_inherited_uids
+        # Inherited scopes never end in this thread, their metrics would never be sent.
+        for uid in inherited_uids - previous_inherited_uids:
+            _logger_context.scope_metrics.pop(uid, None)
+
+
+def current_scope_metrics() -> ScopeMetrics:
+    """
+    Returns metrics of the current scope. They are aggregated in-process and sent with ScopeEndMessage
+    when the scope ends. Metrics recorded in a scope inherited from a parent process are never sent.
+
+    Raises ValueError inside scopes inherited with inherited_scopes() (e.g. in tasks of ScopedThreadPoolExecutor),
+    because they end in the thread that submitted the task, and in the scope inherited by the process
+    (RTBH_LOGGER_SCOPE_ID). Open a scope in the task to record its metrics.
+    """
+    # pylint: disable=no-member
+    logical_scopes = _logger_context.logical_scopes
+    if not logical_scopes:
+        raise ValueError("Scope metrics can only be recorded inside a logger scope")
+
+    uid = logical_scopes[-1].uid
+    if uid in _logger_context.inherited_scope_uids:
+        raise ValueError("Scope metrics cannot be recorded in scope %s inherited from another thread or process, "
+                         "open a new scope to record them" % logical_scopes[-1].name)
+    metrics = _logger_context.scope_metrics.get(uid)
+    if metrics is None:
+        metrics = _logger_context.scope_metrics[uid] = ScopeMetrics()
+    return metrics
+
+
+# Created on first use by get_traceback_registry().
+_traceback_registry: Optional[TracebackRegistry] = None
+
+
+def get_traceback_registry() -> TracebackRegistry:
+    global _traceback_registry  # pylint: disable=global-statement
+    if _traceback_registry is None:
+        _traceback_registry = TracebackRegistry()
+    return _traceback_registry
+
+
+def describe_exception(
         exc_info: Optional[Union[Tuple, BaseException]],
         message: str,
-        args: Union[tuple, dict]) -> Tuple[str, Union[tuple, dict]]:
-    """Returns a tuple (message_with_exception_text, args_with_exception_text).
-    If exc_info is None, returns original (message, args).
+        thread_desc: ThreadDescription) -> Tuple[str, Optional[Occurrence], Optional[TracebackMessage]]:
+    """Returns a tuple (message_with_exception_summary, occurrence, traceback_message).
+
+    Full text of a traceback is formatted only if it has to be sent (see TracebackRegistry), otherwise traceback_message
+    is None. If exc_info is None, returns (message, None, None).
     """
     if not exc_info:
-        return message, args
+        return message, None, None
     if not isinstance(exc_info, tuple):
         exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
-    exc_text = logging.Formatter().formatException(exc_info)
-    message = f'{message}\n{exc_text}'
-    if isinstance(args, (tuple, list)):
-        return message, (tuple(args) + tuple([exc_text]))
-    else:
-        result = dict(args or {})
-        result.update(dict(__exc_text=exc_text))
-        return message, result
+    if exc_info[1] is None:
+        return message, None, None
+
+    import traceback  # pylint: disable=import-outside-toplevel
+
+    fingerprint = traceback_fingerprint(exc_info)
+    occurrence = get_traceback_registry().register(fingerprint)
+    exc_summary = ''.join(traceback.format_exception_only(exc_info[0], exc_info[1])).rstrip()
+    message = f'{message}\n{exc_summary} [traceback {fingerprint}, occurrence #{occurrence.number}]'
+
+    traceback_message = None
+    if occurrence.send_text:
+        traceback_message = TracebackMessage(job_name=thread_desc.job_name,
+                                             build_id=thread_desc.build_id,
+                                             thread_id=thread_desc.uid,
+                                             fingerprint=fingerprint,
+                                             timestamp=time.time(),
+                                             exc_type=exc_info[0].__qualname__,
+                                             exc_text=logging.Formatter().formatException(exc_info),
+                                             occurrences=occurrence.since_text_sent)
+    return message, occurrence, traceback_message
 
 
 def create_log_entry(
@@ -193,7 +319,7 @@ def create_log_entry(
 
     time_now = time.time()
     thread_desc_outdated, logical_scopes, thread_desc = get_context()
-    message, args = maybe_add_exc_text_to_args_and_msg(exc_info, message, args)
+    message, occurrence, traceback_message = describe_exception(exc_info, message, thread_desc)
 
     log_entry = LogEntryMessage(
         thread_id=thread_desc.uid,
@@ -203,12 +329,17 @@ def create_log_entry(
         level=level,
         file=file,
         line=line,
-        args=args)
+        args=args,
+        exc_fingerprint=occurrence.fingerprint if occurrence else None,
+        exc_occurrence=occurrence.number if occurrence else None)
 
+    result = []
     if thread_desc_outdated:
-        return [thread_desc, log_entry]
-
-    return [log_entry]
+        result.append(thread_desc)
+    if traceback_message is not None:
+        result.append(traceback_message)
+    result.append(log_entry)
+    return result
 
 
 def create_scope_start_message() -> List[LogSystemMessage]:
@@ -225,8 +356,24 @@ def create_scope_start_message() -> List[LogSystemMessage]:
 def create_scope_end_message() -> List[LogSystemMessage]:
     time_now = time.time()
     thread_desc_outdated, logical_scopes, thread_desc = get_context()
-    scope_message = ScopeEndMessage(uid=logical_scopes[-1].uid, end_time=time_now,
-                                    job_name=thread_desc.job_name, build_id=thread_desc.build_id)
+    scope = logical_scopes[-1]
+    metrics = _logger_context.scope_metrics.pop(scope.uid, None)
+
+    scope_profiles = _logger_context.scope_profiles
+    profile = None
+    if scope_profiles:
+        wall_time = time_now - scope.start_time
+        profile = scope_profiles.pop(scope.uid, None)
+        parent_profile = scope_profiles.get(logical_scopes[-2].uid) if len(logical_scopes) > 1 else None
+        if parent_profile is not None:
+            parent_profile.children_time += wall_time
+        if profile is not None:
+            profile = profile.finish(wall_time)
+
+    scope_message = ScopeEndMessage(uid=scope.uid, end_time=time_now,
+                                    job_name=thread_desc.job_name, build_id=thread_desc.build_id,
+                                    metrics=metrics.to_dict() if metrics is not None else None,
+                                    profile=profile)
 
     if thread_desc_outdated:
         return [thread_desc, scope_message]
@@ -0,0 +1,68 @@
+import bisect
+from array import array
+from typing import Dict, Sequence
+
+# Upper bounds of histogram buckets, suitable for durations in seconds and for small counts.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets. counts[i] is the number of values v such that buckets[i - 1] < v <= buckets[i],
+    the last count is the number of values greater than all buckets.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = array('Q', bytes(8 * (len(self.buckets) + 1)))
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return dict(buckets=list(self.buckets), counts=self.counts.tolist(), count=self.count, sum=self.sum,
+                    min=self.min, max=self.max)
+
+
+class ScopeMetrics:
+    """
+    Counters, gauges and histograms aggregated in-process for a single scope and sent with its ScopeEndMessage.
+    Use logger.scope.current_scope_metrics() to get metrics of the current scope.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        """Records the last value."""
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """Adds a value to a histogram. Buckets are fixed when the histogram is created."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def to_dict(self):
+        return dict(
+            counters=self.counters,
+            gauges=self.gauges,
+            histograms={name: histogram.to_dict() for name, histogram in self.histograms.items()},
+        )
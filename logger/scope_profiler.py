@@ -0,0 +1,62 @@
+import time
+from typing import Optional
+
+from logger.env import get_float_env
+
+# random and tracemalloc are imported only when a scope is profiled, to keep `import logger` fast.
+# pylint: disable=import-outside-toplevel
+
+# Used by scopes that do not set their own sample rate, read on first use by get_default_sample_rate().
+_default_sample_rate: Optional[float] = None
+
+
+def get_default_sample_rate() -> float:
+    global _default_sample_rate  # pylint: disable=global-statement
+    if _default_sample_rate is None:
+        _default_sample_rate = get_float_env('RTBH_LOGGER_PROFILE_SAMPLE_RATE', 0.0)
+    return _default_sample_rate
+
+
+def should_profile(sample_rate: Optional[float]) -> bool:
+    if sample_rate is None:
+        sample_rate = get_default_sample_rate()
+    if sample_rate <= 0:
+        return False
+    if sample_rate >= 1:
+        return True
+    import random
+
+    return random.random() < sample_rate
+
+
+class ScopeProfile:
+    """
+    Resources used by a single profiled scope, sent with its ScopeEndMessage.
+
+    CPU time is the CPU time of the thread that entered the scope. Allocations are measured only if tracemalloc
+    is tracing and are process-wide (they include allocations made by other threads in the meantime).
+    Exclusive time is the wall time of the scope minus the wall time of its child scopes in the same thread.
+    """
+    __slots__ = ('sample_rate', 'cpu_start', 'allocated_start', 'children_time')
+
+    def __init__(self, sample_rate: Optional[float]):
+        import tracemalloc
+
+        self.sample_rate = get_default_sample_rate() if sample_rate is None else sample_rate
+        self.cpu_start = time.thread_time()
+        self.allocated_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.children_time = 0.0
+
+    def finish(self, wall_time: float) -> dict:
+        import tracemalloc
+
+        result = dict(
+            sample_rate=self.sample_rate,
+            wall_time=wall_time,
+            cpu_time=time.thread_time() - self.cpu_start,
+            children_time=self.children_time,
+            exclusive_time=wall_time - self.children_time,
+        )
+        if self.allocated_start is not None and tracemalloc.is_tracing():
+            result.update(allocated_delta=tracemalloc.get_traced_memory()[0] - self.allocated_start)
+        return result
@@ -0,0 +1,115 @@
+import atexit
+import mmap
+import os
+import struct
+import threading
+import uuid
+from typing import Iterator, Optional
+
+from logger.sender import encode_log_entry
+from logger.structs import LogSender, LogSystemMessage
+
+DEFAULT_SEGMENT_DIR = '/tmp/rtbh-log-segments'
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Segment that is still written to is named `<pid>-<uid>-<seq>.seg.open`, completed segment is renamed to `*.seg`.
+SEGMENT_SUFFIX = '.seg'
+OPEN_SEGMENT_SUFFIX = '.seg.open'
+
+RECORD_HEADER = struct.Struct('<i')
+
+
+class SegmentLogSender(LogSender):
+    """
+    Appends Log System messages to segment files instead of sending them to Log Relay. Meant for batch jobs that
+    log a lot: logging is as fast as writing to memory and Log Relay ingests completed segments later
+    (see logger.rtbh_log_relay.segments).
+
+    Segment is a file of `segment_size` bytes mapped to memory, filled with records: record size (4 bytes int,
+    little endian) followed by an encoded message. Record size 0 marks the end of a segment. Each process writes
+    its own segments. A segment is completed (truncated and renamed) when it is full and when the process exits.
+    """
+
+    def __init__(self, segment_dir: str = DEFAULT_SEGMENT_DIR, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        self.segment_dir = segment_dir
+        self.segment_size = segment_size
+        self.mutex = threading.Lock()
+
+        self.pid = None
+        self.uid = None
+        self.seq_no = 0
+        self.path: Optional[str] = None
+        self.fd: Optional[int] = None
+        self.mmap: Optional[mmap.mmap] = None
+        self.position = 0
+
+        atexit.register(self.close)
+
+    def send_entry(self, log_entry: LogSystemMessage):
+        data = encode_log_entry(log_entry)
+        record_size = RECORD_HEADER.size + len(data)
+
+        with self.mutex:
+            if os.getpid() != self.pid:  # forked or not opened yet
+                self.start_process()
+
+            # Always leave space for the end marker.
+            if self.mmap is None or self.position + record_size + RECORD_HEADER.size > len(self.mmap):
+                self.complete_segment()
+                self.open_segment(max(self.segment_size, record_size + RECORD_HEADER.size))
+
+            RECORD_HEADER.pack_into(self.mmap, self.position, len(data))
+            self.mmap[self.position + RECORD_HEADER.size:self.position + record_size] = data
+            self.position += record_size
+
+    def start_process(self):
+        # Segment of the parent process (if any) is completed by the parent, only release our copies of its handles.
+        if self.mmap is not None:
+            self.mmap.close()
+            os.close(self.fd)
+        self.pid = os.getpid()
+        self.uid = uuid.uuid4().hex[:12]
+        self.seq_no = 0
+        self.path = self.fd = self.mmap = None
+        self.position = 0
+
+    def open_segment(self, size: int):
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.seq_no += 1
+        name = '%d-%s-%06d%s' % (self.pid, self.uid, self.seq_no, OPEN_SEGMENT_SUFFIX)
+        self.path = os.path.join(self.segment_dir, name)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        os.ftruncate(self.fd, size)
+        self.mmap = mmap.mmap(self.fd, size)
+        self.position = 0
+
+    def complete_segment(self):
+        if self.mmap is None:
+            return
+        self.mmap.close()
+        os.ftruncate(self.fd, self.position)
+        os.close(self.fd)
+        os.rename(self.path, self.path[:-len(OPEN_SEGMENT_SUFFIX)] + SEGMENT_SUFFIX)
+        self.path = self.fd = self.mmap = None
+
+    def close(self):
+        with self.mutex:
+            if self.pid == os.getpid():
+                self.complete_segment()
+
+
+def read_segment(path: str) -> Iterator[bytes]:
+    """Yields encoded messages stored in a segment file."""
+    with open(path, 'rb') as segment_file:
+        size = os.fstat(segment_file.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ) as segment:
+            position = 0
+            while position + RECORD_HEADER.size <= size:
+                record_size = RECORD_HEADER.unpack_from(segment, position)[0]
+                if record_size <= 0 or position + RECORD_HEADER.size + record_size > size:
+                    break
+                position += RECORD_HEADER.size
+                yield segment[position:position + record_size]
+                position += record_size
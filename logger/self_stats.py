@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from logger.env import get_float_env
+from logger.scope_metrics import Histogram
+
+# Upper bounds of histogram buckets in seconds, from 1 us to 1 s.
+LATENCY_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+COUNTERS = ('entries_sent', 'bytes_sent', 'retries', 'rejected', 'dropped', 'stats_reported')
+# emit: whole StructuredLogHandler.emit, create_entry: create_log_entry, encode: JSON encoding,
+# mutex_wait: waiting for LocalLogSender's mutex, send: sending an entry and waiting for its ACK.
+HISTOGRAMS = ('emit', 'create_entry', 'encode', 'mutex_wait', 'send')
+
+
+class LoggerStats:
+    """
+    Overhead of the logger in this process: counters and latency histograms (in seconds) of its stages.
+
+    If `report_interval` (RTBH_LOGGER_STATS_INTERVAL env variable, in seconds) is positive, StructuredLogHandler
+    sends a snapshot of the stats as a log entry at most once per interval. Stats are reset in forked processes.
+    """
+
+    def __init__(self, report_interval: Optional[float] = None):
+        """
+        :param report_interval: Defaults to RTBH_LOGGER_STATS_INTERVAL env variable, read on first use.
+        """
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.start_time = time.time()
+        self.last_report_time = time.monotonic()
+        self.counters: Dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.histograms: Dict[str, Histogram] = {name: Histogram(LATENCY_BUCKETS) for name in HISTOGRAMS}
+
+    def check_pid(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.check_pid()
+            self.counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            self.check_pid()
+            self.histograms[name].observe(seconds)
+
+    def entry_sent(self, num_bytes: int, encode_time: float, mutex_wait_time: float, send_time: float):
+        """Records all stats of a sent entry at once, to take the lock once."""
+        with self.lock:
+            self.check_pid()
+            self.counters['entries_sent'] += 1
+            self.counters['bytes_sent'] += num_bytes
+            self.histograms['encode'].observe(encode_time)
+            self.histograms['mutex_wait'].observe(mutex_wait_time)
+            self.histograms['send'].observe(send_time)
+
+    def report_due(self) -> bool:
+        """Returns True at most once per `report_interval`, the caller is expected to report the stats."""
+        if self.report_interval is None:
+            self.report_interval = get_float_env('RTBH_LOGGER_STATS_INTERVAL', 0.0)
+        if self.report_interval <= 0:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.check_pid()
+            if now - self.last_report_time < self.report_interval:
+                return False
+            self.last_report_time = now
+            self.counters['stats_reported'] += 1
+            return True
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self.check_pid()
+            return dict(
+                pid=self.pid,
+                since=self.start_time,
+                counters=dict(self.counters),
+                histograms={name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            )
+
+
+logger_stats = LoggerStats()
+
+
+def get_logger_stats() -> dict:
+    """Returns counters and latency histograms of the logger in this process, see LoggerStats."""
+    return logger_stats.snapshot()
@@ -7,11 +7,47 @@ import struct
 import sys
 import threading
 import time
+from typing import Optional
 
+from logger.self_stats import logger_stats
 from logger.structs import LogEntryMessage, LogSender, LogSystemMessage
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_SERVER_ADDRESS = '/tmp/rtbh-log-relay.socket'
+
+ACK_BYTES = bytes([0x55])
+REJECT_BYTES = bytes([0xEE])
+
+# Larger entries are sent in chunks (protocol v5), see logger.rtbh_log_relay.server.RequestHandler, once Log Relay
+# has acknowledged a protocol v4 message on the connection. Older Log Relays receive them as a single message.
+CHUNKED_ENTRY_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+
+# Levels of log entries dropped by LocalLogSender at each backpressure level reported by Log Relay.
+BACKPRESSURE_DROPPED_LEVELS = ((), ('DEBUG', ), ('DEBUG', 'INFO'))
+# While entries are dropped, one of them is sent at least this often (in seconds) to learn the current level.
+BACKPRESSURE_PROBE_INTERVAL = 1.0
+# After Log Relay refused flow control, it is tried again on a new connection after this many seconds.
+FLOW_CONTROL_RETRY_INTERVAL = 600.0
+
+
+def shard_address(server_address: str, shard: int) -> str:
+    return '%s.%d' % (server_address, shard)
+
+
+def shards_file_path(server_address: str) -> str:
+    """File with the number of shards of a sharded Log Relay, absent if Log Relay is not sharded."""
+    return server_address + '.shards'
+
+
+class FlowControlRefused(Exception):
+    """Log Relay closed a new connection without replying to a protocol v4/v5 message."""
+
+
+def encode_log_entry(log_entry: LogSystemMessage) -> bytes:
+    return json.dumps(log_entry.to_dict()).encode('utf8')
+
 
 class LocalLogSender(LogSender):
     """
@@ -19,17 +55,54 @@ class LocalLogSender(LogSender):
 
     We assume that unix domain socket is a very reliable connection and that (in case of some failure) systemd will restart
     Log Relay daemon promptly, so this sending message to Log Relay blocks until message is delivered to LogForwarder.
+
+    If Log Relay is sharded, each process connects to the shard chosen by its pid.
+
+    Unless RTBH_LOGGER_FLOW_CONTROL env variable is 0, messages are sent with protocol v4/v5: Log Relay reports its
+    backpressure level with each ACK and log entries of levels in BACKPRESSURE_DROPPED_LEVELS are dropped while Log Relay
+    is overloaded. Log Relays that do not support these versions close the connection instead of acknowledging the first
+    message and stay reachable, the message is then sent again with protocol v2 over a new connection. Flow control is
+    tried again when the connection is re-established after an error (e.g. Log Relay was restarted) and every
+    FLOW_CONTROL_RETRY_INTERVAL seconds.
     """
 
-    def __init__(self, server_address='/tmp/rtbh-log-relay.socket'):
+    def __init__(self, server_address=DEFAULT_SERVER_ADDRESS, flow_control: Optional[bool] = None):
         self.pid = None
         self.server_address = server_address
         self.client_socket = None
         self.mutex = threading.Lock()
+        if flow_control is None:
+            flow_control = os.getenv('RTBH_LOGGER_FLOW_CONTROL', '1') != '0'
+        self.flow_control = flow_control
+        # Whether the current connection uses protocol v4/v5, and whether Log Relay has acknowledged such a message.
+        self.connection_flow_control = flow_control
+        self.flow_control_confirmed = False
+        self.flow_control_refused_time = 0.0
+        self.backpressure_level = 0
+        self.last_ack_time = 0.0
+        self.num_dropped = 0
 
     def send_entry(self, log_entry: LogSystemMessage):
+        if self.backpressure_level and self.should_drop(log_entry):
+            return
         self.send_entry_internal(log_entry)
 
+    def should_drop(self, log_entry: LogSystemMessage) -> bool:
+        if not isinstance(log_entry, LogEntryMessage):
+            return False  # scopes and thread descriptions are needed to make sense of kept entries
+        dropped_levels = BACKPRESSURE_DROPPED_LEVELS[min(self.backpressure_level, len(BACKPRESSURE_DROPPED_LEVELS) - 1)]
+        if log_entry.level not in dropped_levels:
+            return False
+        if time.monotonic() - self.last_ack_time >= BACKPRESSURE_PROBE_INTERVAL:
+            return False
+        self.num_dropped += 1
+        logger_stats.count('dropped')
+        if self.num_dropped & (self.num_dropped - 1) == 0:
+            sys.stderr.write("%s Log Relay is overloaded (backpressure level %d), dropped %d %s entries so far\n"
+                             % (datetime.datetime.utcnow(), self.backpressure_level, self.num_dropped,
+                                '/'.join(dropped_levels)))
+        return True
+
     def send_entry_internal(self, log_entry: LogSystemMessage):
         num_errors = 0
         while True:
@@ -37,34 +110,112 @@ class LocalLogSender(LogSender):
                 self.send(log_entry)
                 break
 
-            except Exception as e:
-                num_errors += 1
-                if num_errors & (num_errors - 1) == 0:
-                    sys.stderr.write("%s Failed to send log entry through %s (#errors=%s). Error: %s\n"
-                                     % (datetime.datetime.utcnow(), self.server_address, num_errors, e))
-                time.sleep(1)
+            except FlowControlRefused as e:
+                # If Log Relay can be reached again right away, it is running and does not support protocol v4/v5.
+                # Otherwise it is going down, which is handled like any other error (and flow control is tried again).
                 try:
-                    self.connect()
-                except:  # pylint: disable=bare-except
-                    pass
+                    self.connect(flow_control=False)
+                except Exception:  # pylint: disable=broad-except
+                    num_errors = self.handle_send_error(e, num_errors)
+                    continue
+                sys.stderr.write("%s Log Relay at %s does not support flow control, falling back to protocol v2\n"
+                                 % (datetime.datetime.utcnow(), self.server_address))
+                self.flow_control_refused_time = time.monotonic()
+
+            except Exception as e:  # pylint: disable=broad-except
+                num_errors = self.handle_send_error(e, num_errors)
+
+    def handle_send_error(self, error: Exception, num_errors: int) -> int:
+        """Waits and reconnects after a failed send, never raises. Returns the updated number of errors."""
+        num_errors += 1
+        logger_stats.count('retries')
+        if num_errors & (num_errors - 1) == 0:
+            sys.stderr.write("%s Failed to send log entry through %s (#errors=%s). Error: %s\n"
+                             % (datetime.datetime.utcnow(), self.server_address, num_errors, error))
+        time.sleep(1)
+        try:
+            self.connect()
+        except:  # pylint: disable=bare-except
+            pass
+        return num_errors
 
-    def connect(self):
+    def connect(self, flow_control: Optional[bool] = None):
         with self.mutex:
             self.pid = os.getpid()
+            self.connection_flow_control = self.flow_control if flow_control is None else flow_control
+            self.flow_control_confirmed = False
+            self.backpressure_level = 0
             self.client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.client_socket.connect(self.server_address)
+            self.client_socket.connect(self.get_shard_address())
+
+    def get_shard_address(self) -> str:
+        try:
+            with open(shards_file_path(self.server_address)) as shards_file:
+                num_shards = int(shards_file.read())
+        except (OSError, ValueError):
+            return self.server_address
+        return shard_address(self.server_address, self.pid % num_shards)
 
     def send(self, log_entry: LogEntryMessage):
         if os.getpid() != self.pid:  # forked or not connected
             self.connect()
+        elif (self.flow_control and not self.connection_flow_control
+              and time.monotonic() - self.flow_control_refused_time >= FLOW_CONTROL_RETRY_INTERVAL):
+            self.connect()  # Log Relay might have been upgraded since it refused flow control
 
+        wait_start_time = time.perf_counter()
         with self.mutex:
-            json_bytes = json.dumps(log_entry.to_dict()).encode('utf8')
+            encode_start_time = time.perf_counter()
+            json_bytes = encode_log_entry(log_entry)
+            send_start_time = time.perf_counter()
+            ack = self.send_frame(json_bytes)
+            if self.connection_flow_control:
+                if not ack and not self.flow_control_confirmed:
+                    raise FlowControlRefused("Connection closed without a reply")
+                if ack:
+                    self.read_backpressure_level()
+                    self.flow_control_confirmed = True
+            if ack == REJECT_BYTES:
+                # Retrying would not help.
+                logger_stats.count('rejected')
+                sys.stderr.write("%s Log Relay rejected log entry of %d bytes (too large). Entry dropped.\n"
+                                 % (datetime.datetime.utcnow(), len(json_bytes)))
+            elif ack != ACK_BYTES:
+                raise ValueError("Unexpected ACK: %s" % (ack, ))
+            else:
+                logger_stats.entry_sent(len(json_bytes), encode_time=send_start_time - encode_start_time,
+                                        mutex_wait_time=encode_start_time - wait_start_time,
+                                        send_time=time.perf_counter() - send_start_time)
+
+    def send_frame(self, json_bytes: bytes) -> bytes:
+        """Sends an entry and returns the first byte of the reply (empty if the connection was closed)."""
+        # Log Relays that support protocol v4 support chunked messages as well.
+        if len(json_bytes) > CHUNKED_ENTRY_THRESHOLD and self.connection_flow_control and self.flow_control_confirmed:
+            self.send_chunked(json_bytes)
+        else:
             data_size_bytes = struct.pack('<i', -len(json_bytes))
-            proto_version_bytes = struct.pack('<i', 2)
+            proto_version_bytes = struct.pack('<i', 4 if self.connection_flow_control else 2)
             self.client_socket.sendall(data_size_bytes)
             self.client_socket.sendall(proto_version_bytes)
             self.client_socket.sendall(json_bytes)
-            ack = self.client_socket.recv(1)
-            if ack != bytes([0x55]):
-                raise ValueError("Unexpected ACK: %s" % (ack, ))
+        return self.client_socket.recv(1)
+
+    def read_backpressure_level(self):
+        level = self.client_socket.recv(1)
+        if not level:
+            raise ValueError("Connection closed before backpressure level was received")
+        if level[0] != self.backpressure_level:
+            sys.stderr.write("%s Log Relay backpressure level changed from %d to %d\n"
+                             % (datetime.datetime.utcnow(), self.backpressure_level, level[0]))
+            self.num_dropped = 0
+        self.backpressure_level = level[0]
+        self.last_ack_time = time.monotonic()
+
+    def send_chunked(self, json_bytes: bytes):
+        self.client_socket.sendall(struct.pack('<ii', -1, 5))
+        view = memoryview(json_bytes)
+        for offset in range(0, len(json_bytes), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            self.client_socket.sendall(struct.pack('<i', len(chunk)))
+            self.client_socket.sendall(chunk)
+        self.client_socket.sendall(struct.pack('<i', 0))
@@ -62,13 +62,24 @@ class ScopeEndMessage(NamedTuple):
 
     end_time: TimeStamp
 
+    # Aggregated metrics recorded in the scope, see logger.scope_metrics.ScopeMetrics.
+    metrics: Optional[dict] = None
+
+    # Resources used by the scope if it was profiled, see logger.scope_profiler.ScopeProfile.
+    profile: Optional[dict] = None
+
     def to_dict(self):
-        return dict(
+        result = dict(
             job_name=self.job_name,
             build_id=self.build_id,
             uid=self.uid,
             end_time=self.end_time
         )
+        if self.metrics is not None:
+            result.update(metrics=self.metrics)
+        if self.profile is not None:
+            result.update(profile=self.profile)
+        return result
 
 
 ThreadStartMessage = ThreadDescription
@@ -86,6 +97,10 @@ class LogEntryMessage(NamedTuple):
     message: str
     args: Union[dict, list]
 
+    # Set if the entry was logged with an exception, see TracebackMessage.
+    exc_fingerprint: Optional[str] = None
+    exc_occurrence: Optional[int] = None
+
     def to_dict(self):
         args = self.args
         try:
@@ -93,7 +108,7 @@ class LogEntryMessage(NamedTuple):
         except Exception:  # failed to serialize argument to JSON
             args = str(self.args)
 
-        return dict(
+        result = dict(
             thread_id=self.thread_id,
             scope_id=self.scope_id,
             timestamp=self.timestamp,
@@ -103,9 +118,31 @@ class LogEntryMessage(NamedTuple):
             message=self.message,
             args=args
         )
+        if self.exc_fingerprint is not None:
+            result.update(exc_fingerprint=self.exc_fingerprint, exc_occurrence=self.exc_occurrence)
+        return result
+
+
+class TracebackMessage(NamedTuple):
+    """
+    Full text of a traceback. Log entries only refer to it by its fingerprint, and the text is sent
+    at most once per fingerprint per time window (see logger.tracebacks.TracebackRegistry).
+    """
+    job_name: JobName
+    build_id: BuildId
+    thread_id: Uid
+    fingerprint: str
+
+    timestamp: TimeStamp
+    exc_type: str
+    exc_text: str
+    occurrences: int  # number of occurrences since the previous TracebackMessage with this fingerprint
+
+    def to_dict(self):
+        return self._asdict()  # pylint: disable=no-member
 
 
-LogSystemMessage = Union[ScopeStartMessage, ScopeEndMessage, LogEntryMessage, ThreadStartMessage]
+LogSystemMessage = Union[ScopeStartMessage, ScopeEndMessage, LogEntryMessage, ThreadStartMessage, TracebackMessage]
 
 
 class LogSender:
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple, Type
+
+from logger.env import get_float_env
+
+ExcInfo = Tuple[Type[BaseException], BaseException, object]
+
+
+def traceback_fingerprint(exc_info: ExcInfo) -> str:
+    """
+    Returns a short hash of exception types and code locations (file, function, line) of a traceback,
+    including chained exceptions. Unlike the formatted traceback, it does not depend on exception messages.
+    """
+    import hashlib  # pylint: disable=import-outside-toplevel
+
+    digest = hashlib.blake2b(digest_size=8)
+    exc_type, exc, tb = exc_info
+    seen = set()
+    while True:
+        digest.update(exc_type.__qualname__.encode('utf8'))
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            digest.update(b'%s:%s:%d;' % (code.co_filename.encode('utf8'), code.co_name.encode('utf8'), tb.tb_lineno))
+            tb = tb.tb_next
+
+        # Same rules as traceback.TracebackException.
+        seen.add(id(exc))
+        if exc.__cause__ is not None:
+            exc = exc.__cause__
+        elif exc.__context__ is not None and not exc.__suppress_context__:
+            exc = exc.__context__
+        else:
+            break
+        if id(exc) in seen:
+            break
+        digest.update(b'<-')
+        exc_type, tb = type(exc), exc.__traceback__
+    return digest.hexdigest()
+
+
+class Occurrence(NamedTuple):
+    fingerprint: str
+    number: int  # number of occurrences of this traceback in this process, including this one
+    send_text: bool  # True if full text of the traceback should be sent with this occurrence
+    since_text_sent: int  # number of occurrences since full text was sent last time, including this one
+
+
+class TracebackRegistry:
+    """
+    Counts occurrences of tracebacks (by fingerprint) in this process and decides when their full text is sent:
+    at most once per `window` seconds.
+    """
+
+    def __init__(self, window: Optional[float] = None):
+        if window is None:
+            window = get_float_env('RTBH_LOGGER_TRACEBACK_WINDOW', 60.0)
+        self.window = window
+        self.lock = threading.Lock()
+        self.pid = None
+        # fingerprint -> [number of occurrences, number of occurrences when text was sent, time when text was sent]
+        self.tracebacks: Dict[str, list] = {}
+
+    def register(self, fingerprint: str) -> Occurrence:
+        now = time.monotonic()
+        with self.lock:
+            if self.pid != os.getpid():  # forked, the parent has sent texts to its own connection
+                self.pid = os.getpid()
+                self.tracebacks = {}
+
+            state = self.tracebacks.get(fingerprint)
+            if state is None:
+                state = self.tracebacks[fingerprint] = [0, 0, None]
+            state[0] += 1
+            number, number_at_text, text_time = state
+
+            send_text = text_time is None or now - text_time >= self.window
+            if send_text:
+                state[1], state[2] = number, now
+            return Occurrence(fingerprint, number, send_text, number - number_at_text)